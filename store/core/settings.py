@@ -13,6 +13,8 @@ https://docs.djangoproject.com/en/3.2/ref/settings/
 import os
 from pathlib import Path
 
+from celery.schedules import crontab
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -67,6 +69,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'store.context_processors.catalog',
             ],
         },
     },
@@ -148,16 +151,106 @@ LOGIN_REDIRECT_URL = '/'
 # Add to test email
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
+# Mail queue, see store.mail
+MAIL_BATCH_SIZE = int(os.environ.get('MAIL_BATCH_SIZE', 100))  # messages per SMTP connection
+MAIL_BATCH_DELAY = int(os.environ.get('MAIL_BATCH_DELAY', 5))  # seconds queued mail waits to be batched
+MAIL_RATE_LIMIT = float(os.environ.get('MAIL_RATE_LIMIT', 10))  # messages per second per worker, 0 for no limit
+MAIL_RETRIES = int(os.environ.get('MAIL_RETRIES', 3))  # reconnects per batch
+MAIL_RETRY_DELAY = float(os.environ.get('MAIL_RETRY_DELAY', 2))  # seconds, doubled on each retry
+MAIL_QUEUE_INTERVAL = int(os.environ.get('MAIL_QUEUE_INTERVAL', 60))  # seconds between queue sweeps
+
 # Celery Configuration Options
 CELERY_TIMEZONE = TIME_ZONE
 CELERY_TASK_TRACK_STARTED = True
 CELERY_TASK_TIME_LIMIT = 30 * 60
-CELERY_RESULT_BACKEND = 'django-db'
+# 'django-db', or a Redis URL such as 'redis://127.0.0.1:6379/2' to keep results out of the store database
+CELERY_RESULT_BACKEND = os.environ.get('CELERY_RESULT_BACKEND', 'django-db')
 CELERY_BROKER_URL = 'amqp://localhost:5672'
 CELERY_ACCEPT_CONTENT = ['application/json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 
+# Task results: mail and per-order forwarding ignore theirs, syncs keep them for TASK_RESULT_RETENTION_DAYS
+TASK_RESULT_RETENTION_DAYS = int(os.environ.get('TASK_RESULT_RETENTION_DAYS', 7))
+TASK_RESULT_PRUNE_BATCH_SIZE = int(os.environ.get('TASK_RESULT_PRUNE_BATCH_SIZE', 1000))  # rows per DELETE
+# Redis expires results itself; django-db results are pruned in batches by prune_task_results instead
+CELERY_RESULT_EXPIRES = None if CELERY_RESULT_BACKEND == 'django-db' else TASK_RESULT_RETENTION_DAYS * 24 * 60 * 60
+
+# Separate queues, so a long sync never holds up mail or orders; each has its own workers, see docker-compose.yml
+# (everything else stays on the default `celery` queue)
+CELERY_TASK_ROUTES = {
+    'store.tasks.book_sync': {'queue': 'sync'},
+    'store.tasks.prune_task_results': {'queue': 'sync'},
+    'store.tasks.forward_order': {'queue': 'orders'},
+    'store.tasks.forward_queued_orders': {'queue': 'orders'},
+    'store.tasks.contact_us_send_mail': {'queue': 'mail'},
+    'store.tasks.send_queued_mail': {'queue': 'mail'},
+}
+
+# Warehouse API client
+WAREHOUSE_URL = os.environ.get('WAREHOUSE_URL', 'http://warehouse:8001/')
+WAREHOUSE_CONNECT_TIMEOUT = float(os.environ.get('WAREHOUSE_CONNECT_TIMEOUT', 3))  # seconds
+WAREHOUSE_READ_TIMEOUT = float(os.environ.get('WAREHOUSE_READ_TIMEOUT', 30))  # seconds, default for every call
+WAREHOUSE_POOL_SIZE = int(os.environ.get('WAREHOUSE_POOL_SIZE', 10))  # keep-alive connections, >= sync concurrency
+WAREHOUSE_RETRIES = int(os.environ.get('WAREHOUSE_RETRIES', 3))  # per call, on connection errors and 502/503/504
+WAREHOUSE_BREAKER_THRESHOLD = int(os.environ.get('WAREHOUSE_BREAKER_THRESHOLD', 5))  # failures in a row to open
+WAREHOUSE_BREAKER_RESET_TIMEOUT = int(os.environ.get('WAREHOUSE_BREAKER_RESET_TIMEOUT', 30))  # seconds open
+
+# Catalog events published by the warehouse, applied by `manage.py consume_catalog_events`
+CATALOG_EVENTS_BROKER_URL = os.environ.get('CATALOG_EVENTS_BROKER_URL', CELERY_BROKER_URL)
+CATALOG_EVENTS_EXCHANGE = 'warehouse.catalog'
+CATALOG_EVENTS_QUEUE = 'store.catalog'
+CATALOG_EVENTS_DEAD_QUEUE = 'store.catalog.dead'  # events that could not be applied
+CATALOG_EVENTS_RETRY_DELAY = int(os.environ.get('CATALOG_EVENTS_RETRY_DELAY', 5))  # seconds, warehouse unavailable
+CATALOG_EVENTS_MAX_RETRIES = int(os.environ.get('CATALOG_EVENTS_MAX_RETRIES', 10))  # then the event is dead-lettered
+
+# Catalog sync with the warehouse
+BOOK_SYNC_CHUNK_SIZE = int(os.environ.get('BOOK_SYNC_CHUNK_SIZE', 1000))  # books upserted per transaction
+BOOK_SYNC_PAGE_SIZE = int(os.environ.get('BOOK_SYNC_PAGE_SIZE', 500))  # capped by the warehouse max_page_size
+BOOK_SYNC_CONCURRENCY = int(os.environ.get('BOOK_SYNC_CONCURRENCY', 4))  # feed shards fetched in parallel
+BOOK_SYNC_CURSOR_OVERLAP = int(os.environ.get('BOOK_SYNC_CURSOR_OVERLAP', 120))  # seconds re-read behind the cursor
+BOOK_SYNC_LOCK_TIMEOUT = int(os.environ.get('BOOK_SYNC_LOCK_TIMEOUT', 10 * 60))  # seconds without progress
+# seconds between syncs, or a crontab (minute hour day-of-month month day-of-week); empty to disable
+BOOK_SYNC_SCHEDULE = os.environ.get('BOOK_SYNC_SCHEDULE', '900')
+
+# Catalog pages and fragments are cached until the catalog version changes (book_sync, admin edits)
+CATALOG_CACHE_TIMEOUT = int(os.environ.get('CATALOG_CACHE_TIMEOUT', 24 * 60 * 60))  # seconds
+CATALOG_LOCAL_CACHE_TTL = int(os.environ.get('CATALOG_LOCAL_CACHE_TTL', 10))  # seconds between genre version checks
+
+# Shopping cart storage: 'store.cart.DatabaseCart', or 'store.cart.RedisCart' to keep carts in the Redis cache
+CART_BACKEND = os.environ.get('CART_BACKEND', 'store.cart.DatabaseCart')
+
+# Order forwarding to the warehouse
+ORDER_FORWARD_CONNECT_TIMEOUT = float(os.environ.get('ORDER_FORWARD_CONNECT_TIMEOUT', 3))  # seconds
+ORDER_FORWARD_READ_TIMEOUT = float(os.environ.get('ORDER_FORWARD_READ_TIMEOUT', 10))  # seconds, bulk batches included
+ORDER_FORWARD_MAX_RETRIES = int(os.environ.get('ORDER_FORWARD_MAX_RETRIES', 10))  # backoff doubles up to 10 minutes
+ORDER_FORWARD_BATCH_SIZE = int(os.environ.get('ORDER_FORWARD_BATCH_SIZE', 200))  # at most 500, the warehouse limit
+ORDER_FORWARD_INTERVAL = int(os.environ.get('ORDER_FORWARD_INTERVAL', 60))  # seconds between queue sweeps
+ORDER_FORWARD_CLAIM_TIMEOUT = int(os.environ.get('ORDER_FORWARD_CLAIM_TIMEOUT', 300))  # seconds, then re-forwarded
+ORDER_CALLBACK_TOKEN = os.environ.get('ORDER_CALLBACK_TOKEN', '')  # the warehouse status callback is refused if unset
+
+CELERY_BEAT_SCHEDULE = {
+    'forward-queued-orders': {
+        'task': 'store.tasks.forward_queued_orders',
+        'schedule': ORDER_FORWARD_INTERVAL,
+    },
+    'send-queued-mail': {
+        'task': 'store.tasks.send_queued_mail',
+        'schedule': MAIL_QUEUE_INTERVAL,
+    },
+    'prune-task-results': {
+        'task': 'store.tasks.prune_task_results',
+        'schedule': crontab(minute=30, hour=4),
+    },
+}
+if BOOK_SYNC_SCHEDULE:
+    if BOOK_SYNC_SCHEDULE.isdigit():
+        book_sync_schedule = int(BOOK_SYNC_SCHEDULE)
+    else:
+        minute, hour, day_of_month, month_of_year, day_of_week = BOOK_SYNC_SCHEDULE.split()
+        book_sync_schedule = crontab(minute, hour, day_of_week, day_of_month, month_of_year)
+    CELERY_BEAT_SCHEDULE['book-sync'] = {'task': 'store.tasks.book_sync', 'schedule': book_sync_schedule}
+
 # CACHES for redis
 CACHES = {
     "default": {
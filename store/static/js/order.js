@@ -18,6 +18,25 @@ $(function () {
     });
   };
 
+  var updateRows = function (data) {
+    $.each(data.removed_order_item_ids, function (i, id) {
+      $("#order-item-" + id).remove();
+    });
+    if (data.order_item_id !== null) {
+      var row = $("#order-item-" + data.order_item_id);
+      if (row.length) {
+        row.replaceWith(data.html_order_item);
+      }
+      else {
+        $("#order-table tbody").append(data.html_order_item);
+      }
+    }
+    if (!$("#order-table tbody tr").length) {
+      $("#order-table tbody").html('<tr><td colspan="8" class="text-center bg-warning">No books</td></tr>');
+    }
+    $("#order-table tfoot").html(data.html_order_totals);
+  };
+
   var saveForm = function () {
     var form = $(this);
     $.ajax({
@@ -27,7 +46,7 @@ $(function () {
       dataType: 'json',
       success: function (data) {
         if (data.form_is_valid) {
-          $("#order-table tbody").html(data.html_order_items_list);
+          updateRows(data);
           $("#modal-order").modal("hide");
         }
         else {
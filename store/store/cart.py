@@ -0,0 +1,152 @@
+"""Shopping cart storage, the "In progress" Order or a Redis hash per user, selected with CART_BACKEND."""
+from datetime import date
+from decimal import Decimal
+from functools import cached_property
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import DecimalField, ExpressionWrapper, F, Sum
+from django.http import Http404
+from django.utils.module_loading import import_string
+
+from django_redis import get_redis_connection
+
+from store.models import Book, Order, OrderItem
+
+
+class DatabaseCart:
+    def __init__(self, user):
+        self.user = user
+
+    @cached_property
+    def order(self):
+        order, created = Order.objects.get_or_create(status=Order.OrderStatus.IN_PROGRESS, user=self.user,
+                                                     defaults={'comment': 'added automatically'})
+        return order
+
+    def add(self, book_id):
+        """Adds one copy of the book; returns the new quantity, or None if there is no such book."""
+        return OrderItem.objects.add_book(self.order, book_id)
+
+    def items(self):
+        return OrderItem.objects.filter(order=self.order).select_related('book').prefetch_related('book__author')
+
+    def totals(self):
+        """Number of books and total price of the cart, in one aggregate query."""
+        price = ExpressionWrapper(F('quantity') * F('book__price'), output_field=DecimalField())
+        totals = self.items().aggregate(quantity=Sum('quantity'), price=Sum(price))
+        return {'quantity': totals['quantity'] or 0, 'price': totals['price'] or Decimal('0.00')}
+
+    def get_item(self, pk):
+        try:
+            return self.items().get(pk=pk)
+        except OrderItem.DoesNotExist:
+            raise Http404('No such item in the cart')
+
+    def save_item(self, item):
+        """Saves an edited item, merging it with an item of the same book; returns the pk now holding the book."""
+        try:
+            with transaction.atomic():
+                item.save()
+        except IntegrityError:
+            target = OrderItem.objects.filter(order=self.order, book=item.book)
+            target.update(quantity=F('quantity') + item.quantity)
+            OrderItem.objects.filter(pk=item.pk).delete()
+            return target.values_list('pk', flat=True).get()
+        return item.pk
+
+    def remove_item(self, item):
+        item.delete()
+
+    def checkout(self):
+        """Queues the cart as an order to send; returns it, or None if the cart is empty."""
+        order = Order.objects.filter(status=Order.OrderStatus.IN_PROGRESS, user=self.user).first()
+        if order is None or not order.orderitem_set.exists():
+            return None
+        order.status = Order.OrderStatus.QUEUED
+        order.order_date = date.today()
+        order.save(update_fields=['status', 'order_date'])
+        return order
+
+
+class RedisCart:
+    key_prefix = 'store:cart:'
+    timeout = 30 * 24 * 60 * 60  # abandoned carts expire after 30 days without changes
+
+    def __init__(self, user):
+        self.user = user
+        self.key = f'{self.key_prefix}{user.pk}'
+        self.redis = get_redis_connection('default')
+
+    def add(self, book_id):
+        if not Book.objects.filter(pk=book_id).exists():
+            return None
+        with self.redis.pipeline() as pipe:
+            pipe.hincrby(self.key, book_id, 1)
+            pipe.expire(self.key, self.timeout)
+            quantity, _ = pipe.execute()
+        return quantity
+
+    def items(self):
+        quantities = {int(book_id): int(quantity) for book_id, quantity in self.redis.hgetall(self.key).items()}
+        books = Book.objects.prefetch_related('author').in_bulk(quantities)
+        return [
+            OrderItem(id=book_id, book=books[book_id], quantity=quantity)
+            for book_id, quantity in quantities.items() if book_id in books
+        ]
+
+    def totals(self):
+        items = self.items()
+        return {
+            'quantity': sum(item.quantity for item in items),
+            'price': sum((item.quantity * item.book.price for item in items), Decimal('0.00')),
+        }
+
+    def get_item(self, pk):
+        quantity = self.redis.hget(self.key, pk)
+        book = Book.objects.prefetch_related('author').filter(pk=pk).first()
+        if quantity is None or book is None:
+            raise Http404('No such item in the cart')
+        return OrderItem(id=book.id, book=book, quantity=int(quantity))
+
+    def save_item(self, item):
+        with self.redis.pipeline() as pipe:
+            if item.book_id == item.pk:
+                pipe.hset(self.key, item.book_id, item.quantity)
+            else:
+                pipe.hdel(self.key, item.pk)
+                pipe.hincrby(self.key, item.book_id, item.quantity)
+            pipe.expire(self.key, self.timeout)
+            pipe.execute()
+        return item.book_id
+
+    def remove_item(self, item):
+        self.redis.hdel(self.key, item.pk)
+
+    def checkout(self):
+        # read and clear the hash in one MULTI, so an add racing with the checkout stays for the next cart
+        with self.redis.pipeline() as pipe:
+            pipe.hgetall(self.key)
+            pipe.delete(self.key)
+            cart, _ = pipe.execute()
+        quantities = {int(book_id): int(quantity) for book_id, quantity in cart.items()}
+        book_ids = set(Book.objects.filter(id__in=quantities).values_list('id', flat=True))
+        if not book_ids:
+            return None
+        try:
+            with transaction.atomic():
+                order = Order.objects.create(user=self.user, status=Order.OrderStatus.QUEUED, order_date=date.today())
+                OrderItem.objects.bulk_create([
+                    OrderItem(order=order, book_id=book_id, quantity=quantity)
+                    for book_id, quantity in quantities.items() if book_id in book_ids
+                ])
+        except Exception:
+            for book_id, quantity in quantities.items():
+                self.redis.hincrby(self.key, book_id, quantity)
+            raise
+        return order
+
+
+def get_cart(user):
+    """The cart of `user` in the configured CART_BACKEND."""
+    return import_string(settings.CART_BACKEND)(user)
@@ -0,0 +1,142 @@
+"""Catalog caching keyed on a catalog version that every catalog write bumps."""
+import hashlib
+import logging
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from store.models import Author, Book, Genre
+
+logger = logging.getLogger(__name__)
+
+CATALOG_VERSION_KEY = 'catalog:version'
+LOOKUPS_VERSION_KEY = 'catalog:lookups:version'
+
+
+def _version(key):
+    version = cache.get(key)
+    if version is None:
+        # start from the clock, so a lost version key never brings back entries of an earlier one
+        cache.add(key, int(time.time()), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def _bump(key):
+    try:
+        return cache.incr(key)
+    except ValueError:
+        _version(key)
+        return cache.incr(key)
+
+
+def catalog_version():
+    return _version(CATALOG_VERSION_KEY)
+
+
+def request_catalog_version(request):
+    """The catalog version a request renders under, read once so its page, fragments and lookups agree."""
+    if not hasattr(request, 'catalog_version'):
+        request.catalog_version = catalog_version()
+    return request.catalog_version
+
+
+def bump_catalog_version():
+    return _bump(CATALOG_VERSION_KEY)
+
+
+def lookups_version():
+    return _version(LOOKUPS_VERSION_KEY)
+
+
+def bump_lookups_version():
+    """Makes every process reload its genre and author lookups (after at most CATALOG_LOCAL_CACHE_TTL)."""
+    return _bump(LOOKUPS_VERSION_KEY)
+
+
+class LocalLookupCache:
+    """A per-process copy of a small, rarely changing table, checked against the lookups version."""
+
+    def __init__(self, load):
+        self.load = load
+        self.value = None
+        self.version = None
+        self.checked = 0
+        self.checked_catalog_version = None
+        self.lock = threading.Lock()
+
+    def get(self, catalog_version=None):
+        # checked every CATALOG_LOCAL_CACHE_TTL seconds, and right away under a new catalog version (every lookups
+        # change bumps it too), so a stale copy is never cached under the new version
+        if self._stale(catalog_version):
+            with self.lock:
+                if self._stale(catalog_version):
+                    version = lookups_version()
+                    if self.value is None or version != self.version:
+                        self.value, self.version = self.load(), version
+                    self.checked = time.monotonic()
+                    if catalog_version is not None:
+                        self.checked_catalog_version = catalog_version
+        return self.value
+
+    def _stale(self, catalog_version):
+        return (
+            self.value is None or time.monotonic() - self.checked >= settings.CATALOG_LOCAL_CACHE_TTL
+            or catalog_version is not None and catalog_version != self.checked_catalog_version
+        )
+
+
+genres = LocalLookupCache(lambda: tuple(Genre.objects.order_by('name')))
+
+
+def cache_catalog_page(view):
+    """Caches whole catalog pages of anonymous visitors until the catalog changes."""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD') or request.user.is_authenticated or get_messages(request):
+            return view(request, *args, **kwargs)
+
+        path = hashlib.md5(request.get_full_path().encode()).hexdigest()
+        key = f'catalog:page:{request_catalog_version(request)}:{path}'
+        response = cache.get(key)
+        if response is None:
+            response = view(request, *args, **kwargs)
+            if hasattr(response, 'render'):
+                response.render()
+            if response.status_code != 200:
+                return response
+            # never share a page that hands out a cookie or a CSRF token
+            if response.cookies or request.META.get('CSRF_COOKIE_USED'):
+                logger.warning('Catalog page %s uses a CSRF token or sets a cookie, not cached', request.path)
+            else:
+                cache.set(key, response, settings.CATALOG_CACHE_TIMEOUT)
+        return response
+    return wrapper
+
+
+@receiver(post_save, sender=Book)
+@receiver(post_save, sender=Author)
+@receiver(post_save, sender=Genre)
+@receiver(post_delete, sender=Book)
+@receiver(post_delete, sender=Author)
+@receiver(post_delete, sender=Genre)
+def catalog_changed(sender, **kwargs):
+    """Admin (or any ORM) edits of the catalog; book_sync writes in bulk and bumps the versions itself."""
+    # once committed, so nothing reads the old rows under the new version; lookups first, see LocalLookupCache
+    if sender is not Book:
+        transaction.on_commit(bump_lookups_version)
+    transaction.on_commit(bump_catalog_version)
+
+
+@receiver(m2m_changed, sender=Book.author.through)
+@receiver(m2m_changed, sender=Book.genre.through)
+def catalog_relations_changed(sender, action, **kwargs):
+    if action.startswith('post_'):
+        transaction.on_commit(bump_catalog_version)
@@ -0,0 +1,12 @@
+from django.conf import settings
+from django.utils.functional import SimpleLazyObject
+
+from store.catalog import request_catalog_version
+
+
+def catalog(request):
+    """Catalog version and timeout for `{% cache %}` fragments; the version is only read by pages that use it."""
+    return {
+        'catalog_version': SimpleLazyObject(lambda: request_catalog_version(request)),
+        'catalog_cache_timeout': settings.CATALOG_CACHE_TIMEOUT,
+    }
@@ -0,0 +1,86 @@
+"""Consumer of the warehouse catalog events (see warehouse_api.events), run by `manage.py consume_catalog_events`."""
+import logging
+import time
+
+from django.conf import settings
+from django.db import InterfaceError, OperationalError, close_old_connections
+
+from kombu import Exchange, Queue
+from kombu.exceptions import OperationalError as BrokerError
+from kombu.mixins import ConsumerMixin
+
+from redis.exceptions import RedisError
+
+import requests
+
+from store.tasks import apply_catalog_event
+
+logger = logging.getLogger(__name__)
+
+# the warehouse, the database, Redis or the broker being unavailable; any other error is the event's own
+TRANSIENT_ERRORS = (requests.RequestException, OperationalError, InterfaceError, RedisError, BrokerError)
+
+
+def catalog_queue():
+    """The store's durable queue, bound to the book events of the warehouse catalog exchange."""
+    exchange = Exchange(settings.CATALOG_EVENTS_EXCHANGE, type='topic', durable=True)
+    return Queue(settings.CATALOG_EVENTS_QUEUE, exchange, routing_key='book.*', durable=True)
+
+
+def dead_letter_queue():
+    """Where events that could not be applied are kept for inspection; nothing consumes it."""
+    return Queue(settings.CATALOG_EVENTS_DEAD_QUEUE, durable=True)
+
+
+class CatalogEventsConsumer(ConsumerMixin):
+    """Applies catalog events one at a time, retrying transient failures and dead-lettering the rest."""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def get_consumers(self, Consumer, channel):
+        return [Consumer(queues=[catalog_queue()], callbacks=[self.on_message], accept=['json'], prefetch_count=1)]
+
+    def on_message(self, body, message):
+        headers = message.headers or {}
+        # retried events come back through the default exchange, keyed by the queue name
+        routing_key = headers.get('x-routing-key') or message.delivery_info['routing_key']
+        retries = int(headers.get('x-retries', 0))
+        close_old_connections()
+        try:
+            apply_catalog_event(routing_key, body)
+        except TRANSIENT_ERRORS as error:
+            if retries >= settings.CATALOG_EVENTS_MAX_RETRIES:
+                logger.exception('Could not apply catalog event %s after %s retries, dead-lettered', routing_key,
+                                 retries)
+                self.dead_letter(message, routing_key, error)
+                return
+            logger.exception('Could not apply catalog event %s, retrying', routing_key)
+            time.sleep(settings.CATALOG_EVENTS_RETRY_DELAY)
+            self.publish(message, settings.CATALOG_EVENTS_QUEUE, [catalog_queue()],
+                         {'x-routing-key': routing_key, 'x-retries': retries + 1})
+            message.ack()
+            return
+        except Exception as error:
+            logger.exception('Could not apply catalog event %s, dead-lettered', routing_key)
+            self.dead_letter(message, routing_key, error)
+            return
+        message.ack()
+
+    def on_decode_error(self, message, exc):
+        logger.error('Could not decode catalog event (%s), dead-lettered', exc)
+        self.dead_letter(message, message.delivery_info.get('routing_key'), exc)
+
+    def dead_letter(self, message, routing_key, error):
+        self.publish(message, settings.CATALOG_EVENTS_DEAD_QUEUE, [dead_letter_queue()],
+                     {'x-routing-key': routing_key, 'x-error': repr(error)})
+        message.ack()
+
+    def publish(self, message, queue_name, declare, headers):
+        """Publishes the message as received, so undecodable bodies are kept too; acked by the caller afterwards."""
+        with self.connection.Producer() as producer:
+            producer.publish(
+                message.body, exchange='', routing_key=queue_name, declare=declare,
+                headers={**(message.headers or {}), **headers}, content_type=message.content_type,
+                content_encoding=message.content_encoding, delivery_mode='persistent', retry=True,
+            )
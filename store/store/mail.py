@@ -0,0 +1,62 @@
+"""Outgoing mail, queued in Redis and sent in batches over one SMTP connection per batch."""
+import json
+import logging
+import smtplib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.mail import get_connection
+
+from django_redis import get_redis_connection
+
+logger = logging.getLogger(__name__)
+
+MAIL_QUEUE_KEY = 'store:mail:queue'
+MAIL_FLUSH_KEY = 'mail:flush-scheduled'
+
+
+def queue_mail(subject, message, from_email, recipient_list):
+    """Queues a message with the arguments of django.core.mail.send_mail."""
+    redis = get_redis_connection('default')
+    redis.rpush(MAIL_QUEUE_KEY, json.dumps({
+        'subject': subject, 'body': message, 'from_email': from_email, 'to': list(recipient_list),
+    }))
+    if cache.add(MAIL_FLUSH_KEY, 1, settings.MAIL_BATCH_DELAY):
+        from store.tasks import send_queued_mail
+
+        send_queued_mail.apply_async(countdown=settings.MAIL_BATCH_DELAY)
+
+
+def connection_lost(error):
+    """Whether a send_messages() error is the connection's, rather than one of the message being sent."""
+    if isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, smtplib.SMTPHeloError)):
+        return True
+    # SMTPException subclasses OSError; its other errors (refused sender or recipients, rejected data) are a message's
+    return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
+
+
+def send_batch(messages):
+    """Sends EmailMessages over one connection, at most MAIL_RATE_LIMIT a second; returns how many are done."""
+    done, attempt, next_at = 0, 0, time.monotonic()
+    interval = 1 / settings.MAIL_RATE_LIMIT if settings.MAIL_RATE_LIMIT else 0
+    while done < len(messages):
+        try:
+            with get_connection(fail_silently=False) as connection:
+                for message in messages[done:]:
+                    time.sleep(max(0, next_at - time.monotonic()))
+                    next_at = max(next_at, time.monotonic()) + interval
+                    try:
+                        connection.send_messages([message])
+                    except Exception as error:
+                        if connection_lost(error):
+                            raise
+                        logger.exception('Could not send mail to %s, dropped', ', '.join(message.to))
+                    done += 1
+        except (smtplib.SMTPException, OSError):
+            attempt += 1
+            if attempt > settings.MAIL_RETRIES:
+                logger.exception('Could not send %s of %s mails', len(messages) - done, len(messages))
+                break
+            time.sleep(settings.MAIL_RETRY_DELAY * 2 ** (attempt - 1))
+    return done
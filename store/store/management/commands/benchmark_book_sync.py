@@ -0,0 +1,45 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from store.sync import sync_books
+
+
+def fake_feed(count, offset, price):
+    """Synthetic warehouse feed records shaped like the `/books/` API output."""
+    for number in range(offset, offset + count):
+        yield {
+            'id': number,
+            'title': f'Benchmark book {number}',
+            'summary': 'Benchmark summary',
+            'price': price,
+            'mark': 4.0,
+            'genre': [{'name': f'Benchmark genre {number % 20}'}],
+            'author': [{'name': f'Benchmark author {number % 5000}'}],
+        }
+
+
+class Command(BaseCommand):
+    help = 'Measures the bulk book sync against synthetic data; all changes are rolled back.'  # noqa: A003
+
+    def add_arguments(self, parser):
+        parser.add_argument('--books', type=int, default=100000)
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument('--offset', type=int, default=10 ** 9, help='First synthetic book id')
+
+    def handle(self, *args, **options):
+        books, chunk_size = options['books'], options['chunk_size']
+        with transaction.atomic():
+            for run, price in (('insert', '9.99'), ('update', '19.99'), ('unchanged', '19.99')):
+                with CaptureQueriesContext(connection) as queries:
+                    started = time.monotonic()
+                    sync_books(fake_feed(books, options['offset'], price), chunk_size)
+                    elapsed = time.monotonic() - started
+                chunks = -(-books // chunk_size)
+                self.stdout.write(
+                    f'{run}: {books} books in {elapsed:.2f}s ({books / elapsed:.0f} books/s), '
+                    f'{len(queries)} queries ({len(queries) / chunks:.1f} per chunk)'
+                )
+            transaction.set_rollback(True)
@@ -0,0 +1,26 @@
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+
+from django_redis import get_redis_connection
+
+from store.tasks import BOOK_SYNC_FOLLOW_UP_KEY, BOOK_SYNC_LOCK_KEY, BOOK_SYNC_PROGRESS_KEY, BOOK_SYNC_STATE_KEY
+
+
+class Command(BaseCommand):
+    help = 'Shows whether a book sync is running, how far it got and where the next one starts.'  # noqa: A003
+
+    def handle(self, *args, **options):
+        redis = get_redis_connection('default')
+        progress = cache.get(BOOK_SYNC_PROGRESS_KEY)
+        if redis.exists(BOOK_SYNC_LOCK_KEY):
+            self.stdout.write('Running: ' + ', '.join(f'{key}={value}' for key, value in (progress or {}).items()))
+        else:
+            self.stdout.write('Not running')
+        if redis.exists(BOOK_SYNC_FOLLOW_UP_KEY):
+            self.stdout.write('A follow-up sync is queued')
+        state = cache.get(BOOK_SYNC_STATE_KEY)
+        if state:
+            self.stdout.write(f"Cursors: {state['cursor']}")
+            for feed, checkpoint in state['checkpoint'].items():
+                left = sum(1 for url in checkpoint['streams'].values() if url)
+                self.stdout.write(f'Interrupted {feed} sync, {left} streams left, resumes on the next run')
@@ -0,0 +1,14 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from kombu import Connection
+
+from store.events import CatalogEventsConsumer
+
+
+class Command(BaseCommand):
+    help = 'Applies warehouse catalog events to the store catalog as they arrive.'  # noqa: A003
+
+    def handle(self, *args, **options):
+        with Connection(settings.CATALOG_EVENTS_BROKER_URL) as connection:
+            CatalogEventsConsumer(connection).run()
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.6 on 2026-10-18 08:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0002_alter_order_order_date'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='order',
+            name='status',
+            field=models.PositiveSmallIntegerField(choices=[(1, 'Waiting'), (2, 'In progress'), (3, 'Sent'), (4, 'Done'), (5, 'Rejected'), (6, 'Queued')], default=1, help_text='Order status'),
+        ),
+    ]
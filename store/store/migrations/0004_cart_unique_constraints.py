@@ -0,0 +1,51 @@
+# Generated by Django 3.2.6 on 2026-10-18 08:04
+
+from django.db import migrations, models
+
+
+def merge_duplicates(apps, schema_editor):
+    """Folds extra carts of a user into the oldest one and duplicated items of an order into a single row."""
+    Order = apps.get_model('store', 'Order')
+    OrderItem = apps.get_model('store', 'OrderItem')
+    carts, extra_carts = {}, {}
+    for order in Order.objects.filter(status=2).order_by('user_id', 'order_date', 'id'):
+        if order.user_id in carts:
+            extra_carts[order.id] = carts[order.user_id]
+        else:
+            carts[order.user_id] = order.id
+
+    kept, changed, merged = {}, {}, []
+    for item in OrderItem.objects.exclude(order=None).exclude(book=None).order_by('id'):
+        if item.order_id in extra_carts:
+            item.order_id = extra_carts[item.order_id]
+            changed[item.id] = item
+        key = item.order_id, item.book_id
+        if key in kept:
+            kept[key].quantity += item.quantity
+            changed[kept[key].id] = kept[key]
+            changed.pop(item.id, None)
+            merged.append(item.id)
+        else:
+            kept[key] = item
+    OrderItem.objects.filter(id__in=merged).delete()
+    OrderItem.objects.bulk_update(changed.values(), ['order', 'quantity'], batch_size=500)
+    Order.objects.filter(id__in=extra_carts).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0003_order_status_queued'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='order',
+            constraint=models.UniqueConstraint(condition=models.Q(('status', 2)), fields=('user',), name='store_order_one_cart'),
+        ),
+        migrations.AddConstraint(
+            model_name='orderitem',
+            constraint=models.UniqueConstraint(fields=('order', 'book'), name='store_orderitem_unique_book'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.6 on 2026-10-18 08:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0004_cart_unique_constraints'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['title', 'id'], name='store_book_title_08616e_idx'),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 3.2.6 on 2026-10-18 08:28
+
+from django.db import migrations, models
+
+
+def merge_duplicates(apps, schema_editor):
+    """Folds authors and genres sharing a name into the oldest row, moving their books over to it."""
+    Book = apps.get_model('store', 'Book')
+    for model_name, field in (('Author', 'author'), ('Genre', 'genre')):
+        model = apps.get_model('store', model_name)
+        through = getattr(Book, field).through
+        kept, extra = {}, {}
+        for row_id, name in model.objects.order_by('id').values_list('id', 'name'):
+            if name in kept:
+                extra[row_id] = kept[name]
+            else:
+                kept[name] = row_id
+        if not extra:
+            continue
+
+        linked = set(through.objects.filter(**{f'{field}_id__in': kept.values()}).values_list('book_id', f'{field}_id'))
+        moved = []
+        for link in through.objects.filter(**{f'{field}_id__in': extra}).order_by('id'):
+            key = link.book_id, extra[getattr(link, f'{field}_id')]
+            if key not in linked:
+                linked.add(key)
+                moved.append(through(book_id=key[0], **{f'{field}_id': key[1]}))
+        through.objects.filter(**{f'{field}_id__in': extra}).delete()
+        through.objects.bulk_create(moved, batch_size=500)
+        model.objects.filter(id__in=extra).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0005_book_keyset_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='author',
+            name='name',
+            field=models.CharField(max_length=100, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='genre',
+            name='name',
+            field=models.CharField(max_length=100, unique=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.6 on 2026-10-18 08:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0006_unique_author_genre_names'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='forwarding_started',
+            field=models.DateTimeField(blank=True, editable=False, help_text='When a task claimed the order for forwarding', null=True),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='status',
+            field=models.PositiveSmallIntegerField(choices=[(1, 'Waiting'), (2, 'In progress'), (3, 'Sent'), (4, 'Done'), (5, 'Rejected'), (6, 'Queued'), (7, 'Forwarding')], default=1, help_text='Order status'),
+        ),
+    ]
@@ -2,18 +2,18 @@ import uuid
 
 from django.contrib.auth.models import User
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db import models
+from django.db import connections, models
 
 
 class Author(models.Model):
-    name = models.CharField(max_length=100)
+    name = models.CharField(max_length=100, unique=True)  # book_sync resolves authors by name
 
     def __str__(self):
         return self.name
 
 
 class Genre(models.Model):
-    name = models.CharField(max_length=100)
+    name = models.CharField(max_length=100, unique=True)  # book_sync resolves genres by name
 
     class Meta:
         ordering = ['name']
@@ -35,6 +35,9 @@ class Book(models.Model):
 
     class Meta:
         ordering = ['title']
+        indexes = [
+            models.Index(fields=['title', 'id']),  # keyset pagination of the catalog
+        ]
 
     def __str__(self):
         return self.title
@@ -59,6 +62,8 @@ class Order(models.Model):
         SENT = 3, 'Sent'
         DONE = 4, 'Done'
         REJECTED = 5, 'Rejected'
+        QUEUED = 6, 'Queued'  # checked out, waiting to be forwarded to the warehouse
+        FORWARDING = 7, 'Forwarding'  # claimed by a task that is posting it to the warehouse
 
     id = models.UUIDField(  # noqa: A003
         primary_key=True, default=uuid.uuid4, help_text='Unique ID for this order across whole store'
@@ -70,6 +75,15 @@ class Order(models.Model):
         choices=OrderStatus.choices, default=OrderStatus.WAITING, help_text='Order status'
     )
     comment = models.CharField(max_length=20, blank=True)
+    forwarding_started = models.DateTimeField(
+        null=True, blank=True, editable=False, help_text='When a task claimed the order for forwarding'
+    )
+
+    class Meta:
+        constraints = [
+            # the cart: get_or_create() of concurrent requests can't end up with two of them
+            models.UniqueConstraint(fields=['user'], condition=models.Q(status=2), name='store_order_one_cart'),
+        ]
 
     def __str__(self):
         return f'{self.id}'
@@ -78,10 +92,36 @@ class Order(models.Model):
         return self.id.__str__()
 
 
+class OrderItemQuerySet(models.QuerySet):
+    def add_book(self, order, book_id):
+        """Adds one copy of a book to the order in a single upsert; returns the new quantity, None if no such book."""
+        connection = connections[self.db]
+        quote = connection.ops.quote_name
+        item_table, book = quote(self.model._meta.db_table), Book._meta
+        sql = (
+            f'INSERT INTO {item_table} (order_id, book_id, quantity) '
+            f'SELECT %s, {quote(book.pk.column)}, 1 FROM {quote(book.db_table)} WHERE {quote(book.pk.column)} = %s '
+            f'ON CONFLICT (order_id, book_id) DO UPDATE SET quantity = {item_table}.quantity + 1 '
+            'RETURNING quantity'
+        )
+        order_id = self.model._meta.get_field('order').get_db_prep_value(order.id, connection)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [order_id, book_id])
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+
 class OrderItem(models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE, null=True)
     book = models.ForeignKey(Book, on_delete=models.CASCADE, null=True)
     quantity = models.IntegerField(help_text='Books quantity', default=1)
 
+    objects = OrderItemQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['order', 'book'], name='store_orderitem_unique_book'),
+        ]
+
     def __str__(self):
         return f'{self.id}, {self.book}'
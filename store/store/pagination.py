@@ -0,0 +1,48 @@
+"""Keyset pagination for catalog listings ordered by (title, id)."""
+from django.db.models import Q
+from django.http import Http404
+
+
+def parse_cursor(value):
+    """Parses a `<title>,<id>` cursor; the title may contain commas, the id may not."""
+    title, _, book_id = value.rpartition(',')
+    try:
+        return title, int(book_id)
+    except ValueError:
+        raise Http404('Invalid cursor')
+
+
+class KeysetPage:
+    """A page of a keyset paginated listing and the cursors of its neighbours."""
+
+    def __init__(self, queryset, params, page_size):
+        if params.get('after'):
+            title, book_id = parse_cursor(params['after'])
+            rows = list(queryset.filter(Q(title__gt=title) | Q(title=title, id__gt=book_id))[:page_size + 1])
+            self.has_next, self.has_previous = len(rows) > page_size, True
+            self.object_list = rows[:page_size]
+        elif params.get('before'):
+            title, book_id = parse_cursor(params['before'])
+            rows = list(queryset.filter(Q(title__lt=title) | Q(title=title, id__lt=book_id)).reverse()[:page_size + 1])
+            self.has_next, self.has_previous = True, len(rows) > page_size
+            self.object_list = rows[:page_size][::-1]
+        else:
+            rows = list(queryset[:page_size + 1])
+            self.has_next, self.has_previous = len(rows) > page_size, False
+            self.object_list = rows[:page_size]
+        if not self.object_list:
+            self.has_next = self.has_previous = False
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    @property
+    def next_cursor(self):
+        return f'{self.object_list[-1].title},{self.object_list[-1].id}'
+
+    @property
+    def previous_cursor(self):
+        return f'{self.object_list[0].title},{self.object_list[0].id}'
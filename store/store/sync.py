@@ -0,0 +1,111 @@
+"""Bulk upsert of the warehouse books feed into the store catalog."""
+from collections import defaultdict
+from itertools import islice
+
+from django.db import transaction
+
+from store.catalog import bump_lookups_version
+from store.models import Author, Book, Genre
+
+BOOK_FIELDS = ['title', 'summary', 'price', 'mark']
+BULK_UPDATE_BATCH_SIZE = 100
+
+
+def chunked(iterable, size):
+    """Yields lists of at most `size` items without materializing the whole iterable."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def resolve_names(model, names):
+    """Returns a {name: id} mapping for `names`, creating the missing rows with a single insert."""
+    names = set(names)
+    if not names:
+        return {}
+    ids = dict(model.objects.filter(name__in=names).values_list('name', 'id'))
+    missing = names - ids.keys()
+    if missing:
+        model.objects.bulk_create([model(name=name) for name in missing], ignore_conflicts=True)
+        ids.update(model.objects.filter(name__in=missing).values_list('name', 'id'))
+        transaction.on_commit(bump_lookups_version)
+    return ids
+
+
+def _set_relations(field, name, records, ids):
+    """Brings the M2M `field` rows of the books in `records` in line with the feed; returns the changed book ids."""
+    through = field.through
+    wanted = {
+        (book_id, ids[related['name']])
+        for book_id, record in records.items()
+        for related in record[name]
+    }
+    current = {
+        (book_id, related_id): row_id
+        for row_id, book_id, related_id in through.objects.filter(book_id__in=list(records)).values_list(
+            'id', 'book_id', f'{name}_id'
+        )
+    }
+    stale = {row: row_id for row, row_id in current.items() if row not in wanted}
+    if stale:
+        through.objects.filter(id__in=stale.values()).delete()
+    new = wanted - current.keys()
+    through.objects.bulk_create(
+        [through(book_id=book_id, **{f'{name}_id': related_id}) for book_id, related_id in new],
+        ignore_conflicts=True,
+    )
+    return {book_id for book_id, _ in stale.keys() | new}
+
+
+def upsert_books(records):
+    """Creates or updates the books of one feed chunk with their genres and authors; returns how many changed."""
+    records = {record['id']: record for record in records}  # the latest change of a book wins
+    genre_ids = resolve_names(Genre, (genre['name'] for record in records.values() for genre in record['genre']))
+    author_ids = resolve_names(Author, (author['name'] for record in records.values() for author in record['author']))
+
+    # to_python() turns the JSON values (e.g. price strings) into what the database hands back
+    books = [
+        Book(id=book_id, **{field: Book._meta.get_field(field).to_python(record[field]) for field in BOOK_FIELDS})
+        for book_id, record in records.items()
+    ]
+    existing = {
+        book_id: dict(zip(BOOK_FIELDS, values))
+        for book_id, *values in Book.objects.filter(id__in=records).values_list('id', *BOOK_FIELDS)
+    }
+    created = [book for book in books if book.id not in existing]
+    Book.objects.bulk_create(created, ignore_conflicts=True)
+
+    # bulk_update is by far the most expensive statement here (a CASE per field), so only the fields that
+    # actually changed are written, grouped by the set of changed fields (typically just price or mark)
+    changed = defaultdict(list)
+    for book in books:
+        if book.id in existing:
+            fields = tuple(field for field in BOOK_FIELDS if getattr(book, field) != existing[book.id][field])
+            if fields:
+                changed[fields].append(book)
+    for fields, group in changed.items():
+        Book.objects.bulk_update(group, fields, batch_size=BULK_UPDATE_BATCH_SIZE)
+
+    written = {book.id for book in created}
+    written.update(book.id for group in changed.values() for book in group)
+    written |= _set_relations(Book.genre, 'genre', records, genre_ids)
+    written |= _set_relations(Book.author, 'author', records, author_ids)
+    return len(written)
+
+
+def sync_books(records, chunk_size):
+    """Upserts the `records` feed chunk by chunk, each chunk in its own transaction; returns how many changed."""
+    written = 0
+    for chunk in chunked(records, chunk_size):
+        with transaction.atomic():
+            written += upsert_books(chunk)
+    return written
+
+
+def delete_books(records):
+    """Removes the books listed in a chunk of the deleted books feed; returns how many rows went with them."""
+    deleted, _ = Book.objects.filter(id__in=[record['id'] for record in records]).delete()
+    return deleted
@@ -1,44 +1,367 @@
+import json
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from functools import partial
+
 from celery import shared_task
 
-from django.core.mail import send_mail as django_send_mail
+from django.conf import settings
+from django.core.cache import cache
+from django.core.mail import EmailMessage
+from django.db.models import Prefetch, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from django_celery_results.models import TaskResult
+
+from django_redis import get_redis_connection
 
 import requests
 
-from store.models import Book, Genre
+from store.catalog import bump_catalog_version
+from store.mail import MAIL_QUEUE_KEY, queue_mail, send_batch
+from store.models import Order, OrderItem
+from store.sync import chunked, delete_books, sync_books
+from store.warehouse import get_client
 
+BOOK_SYNC_STATE_KEY = 'book_sync:state'
+BOOK_SYNC_PROGRESS_KEY = 'book_sync:progress'
+BOOK_SYNC_LOCK_KEY = 'store:book_sync:lock'
+BOOK_SYNC_FOLLOW_UP_KEY = 'store:book_sync:follow-up'
 
-@shared_task
+
+@shared_task(ignore_result=True)
 def contact_us_send_mail(subject, message, from_email, recipient_list):
-    django_send_mail(subject, message, from_email, recipient_list)
+    """Kept for tasks queued before the mail queue existed, new mail goes through queue_mail() directly."""
+    queue_mail(subject, message, from_email, recipient_list)
+
+
+@shared_task(ignore_result=True)
+def send_queued_mail():
+    """Sends the mail queue, MAIL_BATCH_SIZE messages per SMTP connection, until it is empty."""
+    redis = get_redis_connection('default')
+    stats = {'sent': 0, 'batches': 0, 'left': 0}
+    lock = redis.lock(f'{MAIL_QUEUE_KEY}:lock', timeout=settings.CELERY_TASK_TIME_LIMIT)
+    if not lock.acquire(blocking=False):
+        return stats
+    try:
+        while True:
+            batch = redis.lrange(MAIL_QUEUE_KEY, 0, settings.MAIL_BATCH_SIZE - 1)
+            if not batch:
+                break
+            sent = send_batch([EmailMessage(**json.loads(item)) for item in batch])
+            redis.ltrim(MAIL_QUEUE_KEY, sent, -1)
+            stats['sent'] += sent
+            stats['batches'] += 1
+            if sent < len(batch):
+                break
+        stats['left'] = redis.llen(MAIL_QUEUE_KEY)
+    finally:
+        lock.release()
+    return stats
+
+
+def _max_cursor(cursor, value):
+    if cursor is None or parse_datetime(value) > parse_datetime(cursor):
+        return value
+    return cursor
+
+
+def _with_overlap(cursor):
+    """The cursor moved back by BOOK_SYNC_CURSOR_OVERLAP seconds, to re-read changes committed late."""
+    if cursor is None:
+        return None
+    return (parse_datetime(cursor) - timedelta(seconds=settings.BOOK_SYNC_CURSOR_OVERLAP)).isoformat()
+
+
+def _feed_url(url, **params):
+    params = {key: value for key, value in params.items() if value is not None}
+    return requests.Request('GET', url, params=params).prepare().url
+
+
+def iter_pages(client, url):
+    """Yields (results, next page URL) for every page of a paginated warehouse feed, one page in memory at a time."""
+    while url:
+        response = client.get(url)
+        response.raise_for_status()
+        page = response.json()
+        yield page['results'], page['next']
+        url = page['next']
+
+
+def _fetch_stream(client, stream, url, pages, stop):
+    """Walks one feed stream and hands its pages to the writer, until the stream ends or the writer gives up."""
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    try:
+        for results, next_url in iter_pages(client, url):
+            put((stream, None, results, next_url))
+            if stop.is_set():
+                return
+    except Exception as error:
+        put((stream, error, None, None))
+
+
+def _sync_feed(client, state, feed, urls, apply, cursor_field, stats, progress):
+    """Applies one change feed, fetching its streams concurrently while the pages are written."""
+    checkpoint = state['checkpoint'].setdefault(
+        feed, {'streams': dict(enumerate(urls)), 'cursor': state['cursor'][feed]}
+    )
+    pending = {stream: url for stream, url in checkpoint['streams'].items() if url}
+    pages = queue.Queue(maxsize=2 * len(pending) or 1)  # bounds memory to a couple of pages per fetcher
+    stop = threading.Event()
+
+    with ThreadPoolExecutor(max_workers=len(pending) or 1) as executor:
+        for stream, url in pending.items():
+            executor.submit(_fetch_stream, client, stream, url, pages, stop)
+        try:
+            while pending:
+                stream, error, results, next_url = pages.get()
+                if error is not None:
+                    raise error
+                # the overlap re-reads books that are already in place
+                if apply(results):
+                    bump_catalog_version()
+                for record in results:
+                    checkpoint['cursor'] = _max_cursor(checkpoint['cursor'], record[cursor_field])
+                checkpoint['streams'][stream] = next_url
+                if next_url is None:
+                    del pending[stream]
+                cache.set(BOOK_SYNC_STATE_KEY, state, timeout=None)
+                stats['pages'] += 1
+                stats['rows'] += len(results)
+                progress(feed, len(pending))
+        finally:
+            stop.set()
+
+    state['cursor'][feed] = checkpoint['cursor']
+    del state['checkpoint'][feed]
+    cache.set(BOOK_SYNC_STATE_KEY, state, timeout=None)
+
+
+@shared_task(bind=True)
+def book_sync(self):
+    """Applies the books changed (and deleted) on the warehouse since the last sync."""
+    redis = get_redis_connection('default')
+    lock = acquire_sync_lock(redis)
+    if lock is None:
+        return {'skipped': True, 'progress': cache.get(BOOK_SYNC_PROGRESS_KEY)}
+    # this run covers the syncs skipped before it started
+    redis.delete(BOOK_SYNC_FOLLOW_UP_KEY)
+
+    try:
+        stats = _book_sync(self, lock)
+    finally:
+        cache.delete(BOOK_SYNC_PROGRESS_KEY)
+        follow_up = release_sync_lock(redis, lock)
+    if follow_up:
+        stats['follow_up'] = True
+    return stats
+
+
+def acquire_sync_lock(redis):
+    """The book_sync lock if it is free, otherwise None after leaving a follow-up note for its holder."""
+    lock = redis.lock(BOOK_SYNC_LOCK_KEY, timeout=settings.BOOK_SYNC_LOCK_TIMEOUT)
+    if lock.acquire(blocking=False):
+        return lock
+    redis.set(BOOK_SYNC_FOLLOW_UP_KEY, 1, ex=settings.BOOK_SYNC_LOCK_TIMEOUT)
+    # the holder may have finished after the first attempt, without seeing the note
+    return lock if lock.acquire(blocking=False) else None
+
+
+def release_sync_lock(redis, lock):
+    """Releases the book_sync lock and queues the follow-up sync noted meanwhile, if any; returns whether it did."""
+    lock.release()
+    if redis.delete(BOOK_SYNC_FOLLOW_UP_KEY):
+        book_sync.delay()
+        return True
+    return False
+
+
+def _book_sync(task, lock):
+    client = get_client()
+    url = client.url('books/')
+    concurrency = settings.BOOK_SYNC_CONCURRENCY
+    page_size = settings.BOOK_SYNC_PAGE_SIZE
+    state = cache.get(BOOK_SYNC_STATE_KEY) or {'cursor': {'books': None, 'deleted': None}, 'checkpoint': {}}
+    stats = {'pages': 0, 'rows': 0}
+    started = time.monotonic()
+    started_at = timezone.now().isoformat()
+
+    def progress(feed, streams_left):
+        lock.reacquire()  # raises LockNotOwnedError, stopping the sync, if the lock expired meanwhile
+        report = {
+            'task_id': task.request.id, 'started': started_at, 'feed': feed, 'streams_left': streams_left,
+            'pages': stats['pages'], 'rows': stats['rows'], 'seconds': round(time.monotonic() - started, 1),
+        }
+        cache.set(BOOK_SYNC_PROGRESS_KEY, report, timeout=settings.BOOK_SYNC_LOCK_TIMEOUT)
+        if task.request.id:
+            task.update_state(state='PROGRESS', meta=report)
+
+    book_urls = [
+        _feed_url(url, updated_since=_with_overlap(state['cursor']['books']), page_size=page_size, instances='false',
+                  shard=shard if concurrency > 1 else None, shards=concurrency if concurrency > 1 else None)
+        for shard in range(concurrency)
+    ]
+    deleted_urls = [
+        _feed_url(f'{url}deleted/', updated_since=_with_overlap(state['cursor']['deleted']), page_size=page_size)
+    ]
+    _sync_feed(client, state, 'books', book_urls,
+               partial(sync_books, chunk_size=settings.BOOK_SYNC_CHUNK_SIZE), 'updated', stats, progress)
+    _sync_feed(client, state, 'deleted', deleted_urls, delete_books, 'deleted', stats, progress)
+
+    stats['seconds'] = round(time.monotonic() - started, 3)
+    stats['pages_per_second'] = round(stats['pages'] / stats['seconds'], 1) if stats['seconds'] else None
+    stats['rows_per_second'] = round(stats['rows'] / stats['seconds'], 1) if stats['seconds'] else None
+    stats['warehouse'] = client.metrics()
+    print('Sync is done')  # noqa:T001
+    return stats
+
+
+def apply_catalog_event(routing_key, body):
+    """Applies a warehouse catalog event under the book_sync lock; returns whether it was applied."""
+    if routing_key not in ('book.changed', 'book.deleted'):
+        return False
+    redis = get_redis_connection('default')
+    lock = acquire_sync_lock(redis)
+    if lock is None:
+        return False
+
+    try:
+        if routing_key == 'book.changed':
+            client = get_client()
+            url = _feed_url(client.url('books/'), ids=','.join(str(book_id) for book_id in body['ids']),
+                            instances='false', page_size=settings.BOOK_SYNC_PAGE_SIZE)
+            written = sum(sync_books(results, settings.BOOK_SYNC_CHUNK_SIZE) for results, _ in iter_pages(client, url))
+        else:
+            written = delete_books([{'id': book_id} for book_id in body['ids']])
+        if written:
+            bump_catalog_version()
+    finally:
+        release_sync_lock(redis, lock)
+    return True
+
+
+def order_payload(order):
+    """The warehouse `/orders/` representation of a store order (expects `user` and `orderitem_set` loaded)."""
+    return {
+        'id': str(order.id),
+        'customer_mail': order.user.email,
+        'customer_name': order.user.get_full_name() or order.user.username,
+        'order_date': str(order.order_date or date.today()),
+        'order_items': [
+            {'book': item.book_id, 'quantity': item.quantity}
+            for item in order.orderitem_set.all() if item.book_id is not None
+        ],
+    }
+
+
+def forwardable():
+    """Queued orders, and orders whose forwarding claim is older than ORDER_FORWARD_CLAIM_TIMEOUT (a lost task)."""
+    stale = timezone.now() - timedelta(seconds=settings.ORDER_FORWARD_CLAIM_TIMEOUT)
+    return Q(status=Order.OrderStatus.QUEUED) | Q(status=Order.OrderStatus.FORWARDING, forwarding_started__lt=stale)
+
+
+def claim_orders(order_ids):
+    """Claims the forwardable orders among `order_ids` with one conditional UPDATE; returns the claimed ones."""
+    claimed_at = timezone.now()
+    Order.objects.filter(forwardable(), id__in=order_ids).update(
+        status=Order.OrderStatus.FORWARDING, forwarding_started=claimed_at
+    )
+    return Order.objects.filter(id__in=order_ids, status=Order.OrderStatus.FORWARDING, forwarding_started=claimed_at)
+
+
+@shared_task(bind=True, autoretry_for=(requests.RequestException,), max_retries=settings.ORDER_FORWARD_MAX_RETRIES,
+             retry_backoff=True, retry_backoff_max=600, retry_jitter=True, acks_late=True, ignore_result=True)
+def forward_order(self, order_id):
+    """Posts a queued order to the warehouse and records its answer on the order status."""
+    claimed = claim_orders([order_id])
+    order = claimed.select_related('user').prefetch_related('orderitem_set').first()
+    if order is None:
+        return None  # already forwarded, being forwarded by the sweep, or taken out of the queue meanwhile
+
+    try:
+        response = get_client().post(
+            'orders/', json=order_payload(order), headers={'Idempotency-Key': str(order.id)},
+            timeout=(settings.ORDER_FORWARD_CONNECT_TIMEOUT, settings.ORDER_FORWARD_READ_TIMEOUT),
+        )
+        if response.status_code >= 500 or response.status_code == 429:
+            response.raise_for_status()  # transient, retried
+    except requests.RequestException:
+        claimed.update(status=Order.OrderStatus.QUEUED)
+        raise
+    # 201 is accepted (or replayed); any other answer (400 invalid, 409 out of stock) won't change on a retry
+    status = Order.OrderStatus.SENT if response.status_code == 201 else Order.OrderStatus.REJECTED
+    claimed.update(status=status)
+    return {'id': order_id, 'status': status.label, 'warehouse_status': response.status_code}
 
 
 @shared_task
-def book_sync():
-    url = 'http://warehouse:8001/books'
-    response = requests.get(url=url).json()
+def forward_queued_orders():
+    """Forwards every queued order to the warehouse bulk endpoint, ORDER_FORWARD_BATCH_SIZE per request."""
+    queued = Order.objects.filter(forwardable()).order_by('id')
+    stats = {'orders': 0, 'sent': 0, 'rejected': 0, 'failed': 0, 'batches': 0, 'batch_seconds': []}
+    client = get_client()
+    started = time.monotonic()
 
-    for counter, book in enumerate(response):
-        if Book.objects.filter(id=book['id']).exists():
+    for order_ids in chunked(queued.values_list('id', flat=True), settings.ORDER_FORWARD_BATCH_SIZE):
+        batch_started = time.monotonic()
+        claimed = claim_orders(order_ids)
+        orders = claimed.select_related('user').prefetch_related(
+            Prefetch('orderitem_set', queryset=OrderItem.objects.only('order', 'book', 'quantity'))
+        )
+        payload = [order_payload(order) for order in orders]
+        if not payload:
             continue
-        else:
-            genre_list = []
-
-            for genre_resp in book['genre']:
-                genre, created = Genre.objects.get_or_create(name=genre_resp['name'])
-                genre_list.append(genre.id)
-
-            book = Book(
-                id=book['id'],
-                title=book['title'],
-                author=book['author'],
-                summary=book['summary'],
-                genre=book['genre'],
-                price=book['price'],
-                mark=book['mark'],
+        try:
+            response = client.post(
+                'orders/bulk/', json=payload,
+                timeout=(settings.ORDER_FORWARD_CONNECT_TIMEOUT, settings.ORDER_FORWARD_READ_TIMEOUT),
             )
-            book.save()
-            for genre in genre_list:
-                book.genre.add(genre)
-                book.save()
+            response.raise_for_status()
+        except requests.RequestException:
+            claimed.update(status=Order.OrderStatus.QUEUED)
+            stats['failed'] += len(payload)
+            break
 
-    print('Sync is done')  # noqa:T001
+        outcome = {Order.OrderStatus.SENT: [], Order.OrderStatus.REJECTED: []}
+        for result in response.json():
+            status = Order.OrderStatus.SENT if result['status'] == 201 else Order.OrderStatus.REJECTED
+            outcome[status].append(result['id'])
+        for status, ids in outcome.items():
+            if ids:
+                claimed.filter(id__in=ids).update(status=status)
+        stats['orders'] += len(payload)
+        stats['sent'] += len(outcome[Order.OrderStatus.SENT])
+        stats['rejected'] += len(outcome[Order.OrderStatus.REJECTED])
+        stats['batches'] += 1
+        stats['batch_seconds'].append(round(time.monotonic() - batch_started, 3))
+
+    stats['seconds'] = round(time.monotonic() - started, 3)
+    stats['orders_per_second'] = round(stats['orders'] / stats['seconds'], 1) if stats['seconds'] else None
+    stats['warehouse'] = client.metrics()
+    return stats
+
+
+@shared_task
+def prune_task_results():
+    """Deletes task results older than TASK_RESULT_RETENTION_DAYS in batches of TASK_RESULT_PRUNE_BATCH_SIZE."""
+    cutoff = timezone.now() - timedelta(days=settings.TASK_RESULT_RETENTION_DAYS)
+    expired = TaskResult.objects.filter(date_done__lt=cutoff).order_by('date_done')
+    stats = {'deleted': 0, 'batches': 0}
+    while True:
+        ids = list(expired.values_list('id', flat=True)[:settings.TASK_RESULT_PRUNE_BATCH_SIZE])
+        if not ids:
+            break
+        stats['deleted'] += TaskResult.objects.filter(id__in=ids).delete()[0]
+        stats['batches'] += 1
+    return stats
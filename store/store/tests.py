@@ -1,3 +1,654 @@
-# from django.test import TestCase
+import json
+import smtplib
+import threading
+import uuid
+from datetime import timedelta
+from functools import partial
+from unittest import mock
+from urllib.parse import urljoin, urlsplit
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.mail import EmailMessage
+from django.core.mail.backends.base import BaseEmailBackend
+from django.db import DatabaseError, connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from django_celery_results.models import TaskResult
+
+import fakeredis
+
+import requests
+
+from . import cart, mail, tasks
+from .catalog import catalog_version, genres
+from .models import Author, Book, Genre, Order, OrderItem
+from .warehouse import WarehouseClient, WarehouseUnavailable
+
+User = get_user_model()
+
+
+def create_books(count):
+    """Books with two authors and two genres each."""
+    authors = [Author.objects.get_or_create(name=f'Author {i}')[0] for i in range(2)]
+    genre_list = [Genre.objects.get_or_create(name=f'Genre {i}')[0] for i in range(2)]
+    books = []
+    for i in range(count):
+        book = Book.objects.create(title=f'Book {i}', summary='Summary', price=10, mark=4)
+        book.author.set(authors)
+        book.genre.set(genre_list)
+        books.append(book)
+    return books
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    CATALOG_LOCAL_CACHE_TTL=0, CART_BACKEND='store.cart.DatabaseCart',
+)
+class QueryBudgetTestCase(TestCase):
+    """The pages take a fixed number of queries however many books they show, so an N+1 shows up here."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.books = create_books(5)
+        cls.genre = Genre.objects.first()
+        cls.user = User.objects.create_user('reader', 'reader@example.com', 'password')
+
+    def setUp(self):
+        cache.clear()
+        # the version restarts from the clock, it may match the one loaded by an earlier test
+        genres.value = None
+        genres.get()
+
+    def assertQueries(self, count, url):
+        with self.assertNumQueries(count):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+
+class BookListQueryTests(QueryBudgetTestCase):
+    def test_book_list(self):
+        # page, then the prefetched authors
+        self.assertQueries(2, reverse('index'))
+
+    def test_keyset_pages(self):
+        # the new books repeat the titles of the fixture's, only their ids tell them apart
+        create_books(7)
+        expected = list(Book.objects.order_by('title', 'id'))
+        first = self.assertQueries(2, reverse('index')).context['page_obj']
+        self.assertEqual(first.object_list, expected[:10])
+        second = self.assertQueries(2, reverse('index') + f'?after={first.next_cursor}').context['page_obj']
+        self.assertEqual((second.object_list, second.has_next), (expected[10:], False))
+        back = self.assertQueries(2, reverse('index') + f'?before={second.previous_cursor}').context['page_obj']
+        self.assertEqual((back.object_list, back.has_previous), (expected[:10], False))
+        self.assertEqual(self.client.get(reverse('index') + '?after=Book').status_code, 404)
+
+    def test_genre(self):
+        # count, page, then the prefetched authors
+        self.assertQueries(3, reverse('genre-detail', args=[self.genre.id]))
+
+    def test_signed_in_pages(self):
+        # not cached as a whole: session and user, then the queries of the anonymous page
+        self.client.force_login(self.user)
+        self.assertQueries(4, reverse('index'))
+        self.assertQueries(5, reverse('genre-detail', args=[self.genre.id]))
+        self.assertQueries(4, reverse('book-detail', args=[self.books[0].id]))
+
+
+class CatalogCacheTests(QueryBudgetTestCase):
+    def test_anonymous_pages_are_cached(self):
+        urls = [reverse('index'), reverse('genre-detail', args=[self.genre.id]),
+                reverse('book-detail', args=[self.books[0].id])]
+        for url, count in zip(urls, [2, 3, 2]):
+            self.assertQueries(count, url)
+            self.assertQueries(0, url)
+        # another page of the listing is a page of its own
+        self.assertQueries(2, reverse('index') + '?after=Book 0,1')
+
+    def test_catalog_change_invalidates_pages(self):
+        self.assertQueries(2, reverse('index'))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.books[0].title = 'Changed'
+            self.books[0].save()
+        response = self.assertQueries(2, reverse('index'))
+        self.assertContains(response, 'Changed')
+        self.assertQueries(0, reverse('index'))
+
+
+class CartAddTests(QueryBudgetTestCase):
+    def test_add_to_order(self):
+        self.client.force_login(self.user)
+        # the first add creates the cart order
+        with self.assertNumQueries(7):
+            self.client.post(reverse('add_to_order', args=[self.books[0].id]))
+        # session, user, cart order, then one upsert
+        for book in self.books[1:] + self.books[:1]:
+            with self.assertNumQueries(4):
+                self.client.post(reverse('add_to_order', args=[book.id]))
+        self.assertEqual(
+            list(OrderItem.objects.filter(order__user=self.user).order_by('book').values_list('quantity', flat=True)),
+            [2, 1, 1, 1, 1],
+        )
+        self.assertEqual(Order.objects.filter(user=self.user).count(), 1)
+        self.assertEqual(self.client.post(reverse('add_to_order', args=[0])).status_code, 404)
+
+    def test_add_book_in_place(self):
+        """Repeated adds on one connection, as interleaved requests would run them, keep one item."""
+        order = Order.objects.create(user=self.user)
+        with transaction.atomic():
+            quantities = [OrderItem.objects.add_book(order, self.books[0].id) for _ in range(3)]
+        quantities.append(OrderItem.objects.add_book(order, self.books[1].id))
+        self.assertEqual(quantities, [1, 2, 3, 1])
+        self.assertEqual(
+            list(OrderItem.objects.filter(order=order).order_by('book').values_list('quantity', flat=True)), [3, 1]
+        )
+        self.assertIsNone(OrderItem.objects.add_book(order, 0))
+
+
+class CartPageTests(QueryBudgetTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+        for book in self.books:
+            self.client.post(reverse('add_to_order', args=[book.id]))
+        self.item = OrderItem.objects.get(book=self.books[0])
+
+    def test_cart_page(self):
+        # session, user, cart order, totals, items, then the prefetched authors
+        response = self.assertQueries(6, reverse('order'))
+        self.assertEqual(response.context['totals'], {'quantity': 5, 'price': 50})
+
+    def test_saved_form_is_not_rendered_again(self):
+        url = reverse('order_update', args=[self.item.id])
+        self.assertIn('html_form', self.client.get(url).json())
+
+        data = self.client.post(url, {'book': self.books[1].id, 'quantity': ''}).json()
+        self.assertFalse(data['form_is_valid'])
+        self.assertIn('html_form', data)
+
+        data = self.client.post(url, {'book': self.books[1].id, 'quantity': 3}).json()
+        self.assertTrue(data['form_is_valid'])
+        self.assertNotIn('html_form', data)
+        # moved onto a book already in the cart, so merged into its row
+        item = OrderItem.objects.get(book=self.books[1])
+        self.assertEqual((data['order_item_id'], data['removed_order_item_ids']), (item.id, [self.item.id]))
+        self.assertEqual(item.quantity, 4)
+
+    def test_delete(self):
+        url = reverse('order_item_delete', args=[self.item.id])
+        self.assertIn('html_form', self.client.get(url).json())
+
+        data = self.client.post(url).json()
+        self.assertEqual(data['removed_order_item_ids'], [self.item.id])
+        self.assertNotIn('html_form', data)
+        self.assertIn('<th>4</th>', data['html_order_totals'])
+        self.assertFalse(OrderItem.objects.filter(pk=self.item.id).exists())
+
+
+@override_settings(CART_BACKEND='store.cart.RedisCart')
+class RedisCartTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.books = create_books(3)
+        cls.user = User.objects.create_user('reader', 'reader@example.com', 'password')
+
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        patcher = mock.patch.object(cart, 'get_redis_connection', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client.force_login(self.user)
+
+    def add(self, *books):
+        for book in books:
+            self.client.post(reverse('add_to_order', args=[book.id]))
+
+    def test_cart_is_not_written_to_the_database(self):
+        # session, user, then whether the book exists
+        with self.assertNumQueries(3):
+            self.add(self.books[0])
+        self.add(self.books[0], self.books[1])
+        self.assertFalse(Order.objects.exists())
+        key = f'store:cart:{self.user.pk}'
+        quantities = {int(book_id): int(quantity) for book_id, quantity in self.redis.hgetall(key).items()}
+        self.assertEqual(quantities, {self.books[0].id: 2, self.books[1].id: 1})
+        self.assertGreater(self.redis.ttl(key), 0)
+        self.assertEqual(self.client.post(reverse('add_to_order', args=[0])).status_code, 404)
+
+        response = self.client.get(reverse('order'))
+        self.assertEqual(response.context['totals'], {'quantity': 3, 'price': 30})
+
+    def test_edit_and_remove(self):
+        self.add(self.books[0], self.books[1])
+        # moved onto a book already in the cart, so merged into its row
+        data = self.client.post(
+            reverse('order_update', args=[self.books[0].id]), {'book': self.books[1].id, 'quantity': 2}
+        ).json()
+        self.assertEqual(data['order_item_id'], self.books[1].id)
+        self.assertEqual(data['removed_order_item_ids'], [self.books[0].id])
+        self.client.post(reverse('order_item_delete', args=[self.books[1].id]))
+        self.assertEqual(self.client.get(reverse('order_item_delete', args=[self.books[1].id])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('order')).context['totals'], {'quantity': 0, 'price': 0})
+
+    def test_checkout(self):
+        self.add(self.books[0], self.books[0], self.books[2])
+        self.client.post(reverse('order_send'))
+        order = Order.objects.get()
+        self.assertEqual((order.user, order.status), (self.user, Order.OrderStatus.QUEUED))
+        self.assertEqual(
+            sorted(order.orderitem_set.values_list('book', 'quantity')), [(self.books[0].id, 2), (self.books[2].id, 1)]
+        )
+        self.assertFalse(self.redis.exists(f'store:cart:{self.user.pk}'))
+
+    def test_failed_checkout_keeps_the_cart(self):
+        self.add(self.books[0], self.books[1])
+        with mock.patch.object(OrderItem.objects, 'bulk_create', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                cart.get_cart(self.user).checkout()
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(cart.get_cart(self.user).totals()['quantity'], 2)
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}, CATALOG_LOCAL_CACHE_TTL=3600,
+)
+class GenreLookupTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.fiction, cls.poetry = Genre.objects.create(name='Fiction'), Genre.objects.create(name='Poetry')
+
+    def setUp(self):
+        cache.clear()
+        genres.value = None
+
+    def test_genre_change_with_a_warm_local_cache(self):
+        poetry_url = reverse('genre-detail', args=[self.poetry.id])
+        self.assertContains(self.client.get(reverse('index')), 'Poetry')
+        self.assertEqual(self.client.get(poetry_url).status_code, 200)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.fiction.name = 'Novels'
+            self.fiction.save()
+            self.poetry.delete()
+
+        response = self.client.get(reverse('index'))
+        self.assertContains(response, 'Novels')
+        self.assertNotContains(response, 'Poetry')
+        self.assertEqual(self.client.get(poetry_url).status_code, 404)
+
+
+class FakeWarehouse:
+    """Serves one page per feed, from `feeds` keyed by path."""
+
+    def __init__(self, feeds):
+        self.feeds = feeds
+
+    def url(self, path):
+        return urljoin('http://warehouse/', path)
+
+    def get(self, url):
+        page = {'results': self.feeds.get(urlsplit(url).path.lstrip('/'), []), 'next': None}
+        return mock.Mock(json=mock.Mock(return_value=page), raise_for_status=mock.Mock())
+
+    def metrics(self):
+        return {}
+
+
+def book_record(book_id, price='10.00'):
+    return {
+        'id': book_id, 'title': f'Book {book_id}', 'summary': 'Summary', 'price': price, 'mark': 4.0,
+        'updated': '2021-09-01T00:00:00+00:00', 'author': [{'name': 'Author'}], 'genre': [{'name': 'Genre'}],
+    }
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}, BOOK_SYNC_CONCURRENCY=1,
+)
+class BookSyncTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.redis = fakeredis.FakeStrictRedis()
+        mock.patch.object(tasks, 'get_redis_connection', return_value=self.redis).start()
+        self.delay = mock.patch.object(tasks.book_sync, 'delay').start()
+        self.addCleanup(mock.patch.stopall)
+
+    def sync(self, books=(), deleted=(), warehouse=None):
+        warehouse = warehouse or FakeWarehouse({'books/': list(books), 'books/deleted/': list(deleted)})
+        with mock.patch.object(tasks, 'get_client', return_value=warehouse):
+            return tasks.book_sync.run()
+
+    def test_unchanged_books_keep_the_catalog_version(self):
+        self.sync([book_record(1)])
+        version = catalog_version()
+        # the cursor overlap hands the same book over again
+        self.sync([book_record(1)], [{'id': 2, 'deleted': '2021-09-01T00:00:00+00:00'}])
+        self.assertEqual(catalog_version(), version)
+
+        self.sync([book_record(1, price='12.00')])
+        self.assertGreater(catalog_version(), version)
+        self.assertEqual(Book.objects.get().price, 12)
+
+    def test_skipped_while_another_sync_runs(self):
+        lock = self.redis.lock(tasks.BOOK_SYNC_LOCK_KEY)
+        lock.acquire()
+        self.assertEqual(self.sync([book_record(1)]), {'skipped': True, 'progress': None})
+        self.assertFalse(Book.objects.exists())
+        # its holder is left a note to run again once it is done
+        self.assertTrue(self.redis.exists(tasks.BOOK_SYNC_FOLLOW_UP_KEY))
+        lock.release()
+
+    def test_follow_up_after_a_skipped_sync(self):
+        warehouse = FakeWarehouse({'books/': [book_record(1)]})
+        skipped = []
+
+        def get(url):
+            if not skipped:
+                skipped.append(tasks.book_sync.run())
+            return FakeWarehouse.get(warehouse, url)
+
+        warehouse.get = get
+        stats = self.sync(warehouse=warehouse)
+        self.assertTrue(skipped[0]['skipped'])
+        self.assertTrue(stats['follow_up'])
+        self.delay.assert_called_once_with()
+
+        # a sync nobody asked for meanwhile queues nothing
+        self.assertNotIn('follow_up', self.sync([book_record(1)]))
+        self.delay.assert_called_once_with()
+
+    def test_catalog_event_left_to_a_running_sync(self):
+        lock = self.redis.lock(tasks.BOOK_SYNC_LOCK_KEY)
+        lock.acquire()
+        self.assertFalse(tasks.apply_catalog_event('book.deleted', {'ids': [1]}))
+        self.assertTrue(tasks.release_sync_lock(self.redis, lock))
+        self.delay.assert_called_once_with()
+
+
+def warehouse_response(status_code, data=None):
+    response = requests.Response()
+    response.status_code, response._content = status_code, json.dumps(data).encode()
+    return response
+
+
+class ForwardOrderTests(TestCase):
+    def setUp(self):
+        self.book, = create_books(1)
+        self.user = User.objects.create_user('reader', 'reader@example.com', 'password')
+        self.order = Order.objects.create(user=self.user, status=Order.OrderStatus.QUEUED)
+        OrderItem.objects.create(order=self.order, book=self.book, quantity=2)
+        self.warehouse = mock.Mock()
+        patcher = mock.patch.object(tasks, 'get_client', return_value=self.warehouse)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def forward(self, response):
+        self.warehouse.post.return_value = response
+        result = tasks.forward_order(str(self.order.id))
+        self.order.refresh_from_db()
+        return result
+
+    def test_accepted(self):
+        self.forward(warehouse_response(201))
+        self.assertEqual(self.order.status, Order.OrderStatus.SENT)
+        (path,), kwargs = self.warehouse.post.call_args
+        self.assertEqual((path, kwargs['headers']), ('orders/', {'Idempotency-Key': str(self.order.id)}))
+        self.assertEqual(kwargs['json']['order_items'], [{'book': self.book.id, 'quantity': 2}])
+
+    def test_refused(self):
+        self.forward(warehouse_response(409))
+        self.assertEqual(self.order.status, Order.OrderStatus.REJECTED)
+
+    def test_unavailable_warehouse_is_retried(self):
+        with self.assertRaises(requests.HTTPError):
+            self.forward(warehouse_response(503))
+        # back in the queue for the retry
+        self.assertEqual(self.order.status, Order.OrderStatus.QUEUED)
+
+    def test_claimed_order_is_not_sent_again(self):
+        Order.objects.filter(pk=self.order.pk).update(
+            status=Order.OrderStatus.FORWARDING, forwarding_started=timezone.now()
+        )
+        self.assertIsNone(self.forward(warehouse_response(201)))
+        self.warehouse.post.assert_not_called()
+        self.assertEqual(self.order.status, Order.OrderStatus.FORWARDING)
+
+
+@override_settings(ORDER_FORWARD_BATCH_SIZE=2, ORDER_FORWARD_CLAIM_TIMEOUT=60)
+class ForwardQueuedOrdersTests(TestCase):
+    def setUp(self):
+        self.book, = create_books(1)
+        user = User.objects.create_user('reader', 'reader@example.com', 'password')
+        self.orders = sorted(
+            (Order.objects.create(user=user, status=Order.OrderStatus.QUEUED) for _ in range(4)), key=lambda o: o.id
+        )
+        for order in self.orders:
+            OrderItem.objects.create(order=order, book=self.book)
+        self.sent, self.refused, self.during_first_batch = [], set(), None
+        self.warehouse = mock.Mock(**{'post.side_effect': self.answer})
+        patcher = mock.patch.object(tasks, 'get_client', return_value=self.warehouse)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def answer(self, path, json, **kwargs):
+        if path == 'orders/':
+            self.sent.append(json['id'])
+            return warehouse_response(201)
+        if self.during_first_batch:
+            self.during_first_batch, run = None, self.during_first_batch
+            run()
+        self.sent += [order['id'] for order in json]
+        return warehouse_response(207, [
+            {'id': order['id'], 'status': 409 if order['id'] in self.refused else 201} for order in json
+        ])
+
+    def statuses(self):
+        return [Order.objects.get(pk=order.pk).status for order in self.orders]
+
+    def test_batches(self):
+        self.refused.add(str(self.orders[3].id))
+        stats = tasks.forward_queued_orders()
+        self.assertEqual((stats['batches'], stats['sent'], stats['rejected']), (2, 3, 1))
+        self.assertEqual(self.statuses(), [Order.OrderStatus.SENT] * 3 + [Order.OrderStatus.REJECTED])
+
+    def test_no_order_is_sent_twice(self):
+        # a forward_order task takes an order of the second batch while the first one is being sent
+        self.during_first_batch = partial(tasks.forward_order, str(self.orders[2].id))
+        tasks.forward_queued_orders()
+        self.assertEqual(sorted(self.sent), sorted(str(order.id) for order in self.orders))
+        self.assertEqual(self.statuses(), [Order.OrderStatus.SENT] * 4)
+
+    def test_failed_batch_stops_the_run(self):
+        self.warehouse.post.side_effect = requests.ConnectionError
+        self.assertEqual(tasks.forward_queued_orders()['failed'], 2)
+        self.assertEqual(self.warehouse.post.call_count, 1)
+        self.assertEqual(self.statuses(), [Order.OrderStatus.QUEUED] * 4)
+
+    def test_lost_claims_are_taken_over(self):
+        Order.objects.filter(pk=self.orders[0].pk).update(
+            status=Order.OrderStatus.FORWARDING, forwarding_started=timezone.now() - timedelta(seconds=61)
+        )
+        Order.objects.filter(pk=self.orders[1].pk).update(
+            status=Order.OrderStatus.FORWARDING, forwarding_started=timezone.now()
+        )
+        tasks.forward_queued_orders()
+        self.assertNotIn(str(self.orders[1].id), self.sent)
+        self.assertEqual(self.statuses()[:2], [Order.OrderStatus.SENT, Order.OrderStatus.FORWARDING])
+
+
+class WarehouseClientTests(SimpleTestCase):
+    def setUp(self):
+        self.warehouse = WarehouseClient('http://warehouse/', breaker_threshold=2, breaker_reset_timeout=30)
+        self.session = mock.patch.object(self.warehouse.session, 'request').start()
+        self.addCleanup(mock.patch.stopall)
+        self.now = 1000.0
+        mock.patch('store.warehouse.time', monotonic=lambda: self.now).start()
+
+    def test_breaker_opens_and_closes(self):
+        self.session.return_value = warehouse_response(503)
+        self.warehouse.get('books/')
+        self.assertEqual(self.warehouse.breaker.state, 'closed')
+        self.warehouse.get('books/')
+        self.assertEqual(self.warehouse.breaker.state, 'open')
+        with self.assertRaises(WarehouseUnavailable):
+            self.warehouse.get('books/')
+        self.assertEqual(self.session.call_count, 2)
+
+        # one trial call once the reset timeout passed, the others still fail fast meanwhile
+        self.now += 30
+        self.assertEqual(self.warehouse.breaker.state, 'half-open')
+        self.session.return_value = warehouse_response(200)
+        self.assertTrue(self.warehouse.breaker.allow())
+        self.assertFalse(self.warehouse.breaker.allow())
+        self.warehouse.breaker.record(True)
+        self.assertEqual(self.warehouse.breaker.state, 'closed')
+        self.assertEqual(self.warehouse.get('books/').status_code, 200)
+        self.assertEqual(self.warehouse.metrics()['short_circuited'], 1)
+
+    def test_failed_trial_opens_again(self):
+        self.session.side_effect = requests.ConnectionError
+        for _ in range(2):
+            with self.assertRaises(requests.ConnectionError):
+                self.warehouse.get('books/')
+        self.now += 30
+        with self.assertRaises(requests.ConnectionError):
+            self.warehouse.get('books/')
+        self.assertEqual(self.warehouse.breaker.state, 'open')
+
+    def test_trial_ends_whatever_it_raises(self):
+        self.session.side_effect = requests.ConnectionError
+        for _ in range(2):
+            with self.assertRaises(requests.ConnectionError):
+                self.warehouse.get('books/')
+        self.now += 30
+        self.session.side_effect = ValueError
+        with self.assertRaises(ValueError):
+            self.warehouse.get('books/')
+        # counted as a failure rather than leaving the trial taken for good
+        self.assertFalse(self.warehouse.breaker.trial)
+        self.now += 30
+        self.session.side_effect = None
+        self.session.return_value = warehouse_response(200)
+        self.assertEqual(self.warehouse.get('books/').status_code, 200)
+        self.assertEqual(self.warehouse.breaker.state, 'closed')
+
+
+class FlakyEmailBackend(BaseEmailBackend):
+    """Records what it sends; `failures` holds the error of each send_messages() call in turn, None to send."""
+
+    sent, failures, connections = [], [], 0
+
+    def open(self):  # noqa: A003
+        FlakyEmailBackend.connections += 1
+
+    def send_messages(self, email_messages):
+        error = self.failures.pop(0) if self.failures else None
+        if error:
+            raise error
+        self.sent.extend(message.subject for message in email_messages)
+        return len(email_messages)
+
+
+@override_settings(
+    EMAIL_BACKEND='store.tests.FlakyEmailBackend', MAIL_RATE_LIMIT=0, MAIL_RETRIES=1, MAIL_RETRY_DELAY=0,
+    MAIL_BATCH_SIZE=2, CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+)
+class MailTests(TestCase):
+    def setUp(self):
+        FlakyEmailBackend.sent, FlakyEmailBackend.failures, FlakyEmailBackend.connections = [], [], 0
+        self.messages = [EmailMessage(subject=f'Mail {i}', to=['reader@example.com']) for i in range(3)]
+
+    def test_one_connection_per_batch(self):
+        self.assertEqual(mail.send_batch(self.messages), 3)
+        self.assertEqual((FlakyEmailBackend.sent, FlakyEmailBackend.connections), (['Mail 0', 'Mail 1', 'Mail 2'], 1))
+
+    def test_lost_connection_resumes_the_batch(self):
+        FlakyEmailBackend.failures = [None, smtplib.SMTPServerDisconnected()]
+        self.assertEqual(mail.send_batch(self.messages), 3)
+        self.assertEqual((FlakyEmailBackend.sent, FlakyEmailBackend.connections), (['Mail 0', 'Mail 1', 'Mail 2'], 2))
+
+    def test_refused_message_is_dropped(self):
+        FlakyEmailBackend.failures = [smtplib.SMTPRecipientsRefused({})]
+        self.assertEqual(mail.send_batch(self.messages), 3)
+        self.assertEqual(FlakyEmailBackend.sent, ['Mail 1', 'Mail 2'])
+
+    def test_gives_up_after_the_retries(self):
+        FlakyEmailBackend.failures = [None] + [ConnectionRefusedError()] * 2
+        self.assertEqual(mail.send_batch(self.messages), 1)
+        self.assertEqual(FlakyEmailBackend.connections, 2)
+
+    def test_send_queued_mail(self):
+        redis = fakeredis.FakeStrictRedis()
+        with mock.patch.object(mail, 'get_redis_connection', return_value=redis), \
+                mock.patch.object(tasks, 'get_redis_connection', return_value=redis), \
+                mock.patch.object(tasks.send_queued_mail, 'apply_async') as apply_async:
+            for i in range(5):
+                mail.queue_mail(f'Mail {i}', 'Message', 'reader@example.com', ['admin@example.com'])
+            # one delayed run collects the queue
+            self.assertEqual(apply_async.call_count, 1)
+
+            FlakyEmailBackend.failures = [None, None, None] + [ConnectionRefusedError()] * 2
+            self.assertEqual(tasks.send_queued_mail(), {'sent': 3, 'batches': 2, 'left': 2})
+            # the unsent rest stays at the head of the queue
+            self.assertEqual(tasks.send_queued_mail(), {'sent': 2, 'batches': 1, 'left': 0})
+        self.assertEqual(FlakyEmailBackend.sent, [f'Mail {i}' for i in range(5)])
+
+
+class TaskPolicyTests(TestCase):
+    def test_routes(self):
+        queues = {
+            'book_sync': 'sync', 'prune_task_results': 'sync', 'forward_order': 'orders',
+            'forward_queued_orders': 'orders', 'send_queued_mail': 'mail', 'contact_us_send_mail': 'mail',
+        }
+        router = tasks.book_sync.app.amqp.router
+        for name, queue in queues.items():
+            self.assertEqual(router.route({}, f'store.tasks.{name}')['queue'].name, queue, name)
+        self.assertEqual(router.route({}, 'store.tasks.unrouted')['queue'].name, 'celery')
+
+    def test_results(self):
+        # an order's outcome is its status and mail has none, only syncs keep theirs
+        for task in [tasks.forward_order, tasks.send_queued_mail, tasks.contact_us_send_mail]:
+            self.assertTrue(task.ignore_result, task.name)
+        for task in [tasks.book_sync, tasks.forward_queued_orders, tasks.prune_task_results]:
+            self.assertFalse(task.ignore_result, task.name)
+
+    @override_settings(TASK_RESULT_RETENTION_DAYS=7, TASK_RESULT_PRUNE_BATCH_SIZE=2)
+    def test_prune_task_results(self):
+        for days in [8, 8, 9, 10, 30, 6]:
+            result = TaskResult.objects.create(task_id=str(uuid.uuid4()), status='SUCCESS')
+            TaskResult.objects.filter(pk=result.pk).update(date_done=timezone.now() - timedelta(days=days))
+        self.assertEqual(tasks.prune_task_results(), {'deleted': 5, 'batches': 3})
+        self.assertEqual(TaskResult.objects.count(), 1)
+
+
+class ConcurrentCartTests(TransactionTestCase):
+    def setUp(self):
+        if connection.vendor == 'sqlite':
+            self.skipTest('SQLite takes one writer at a time')
+
+    def test_add_book(self):
+        """Concurrent adds of the same book to one order all land on its one item."""
+        book, = create_books(1)
+        order = Order.objects.create(user=User.objects.create_user('reader'))
+        adds = 8
+        barrier = threading.Barrier(adds)
+        quantities = []
+
+        def add():
+            try:
+                barrier.wait()
+                quantities.append(OrderItem.objects.add_book(order, book.id))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=add) for _ in range(adds)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(quantities), list(range(1, adds + 1)))
+        item = OrderItem.objects.get(order=order)
+        self.assertEqual((item.book_id, item.quantity), (book.id, adds))
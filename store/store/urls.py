@@ -12,4 +12,5 @@ urlpatterns = [
     path('order/send/', views.order_send, name='order_send'),
     path('order/<int:pk>/update/', views.order_item_update, name='order_update'),
     path('order/<int:pk>/delete/', views.order_items_delete, name='order_item_delete'),
+    path('orders_api/', views.order_status_callback, name='order_status_callback'),
 ]
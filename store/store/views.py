@@ -1,26 +1,34 @@
+import hmac
 import json
+import uuid
+from functools import partial
 
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import authenticate, get_user_model, login
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.messages.views import SuccessMessageMixin
 from django.core.paginator import Paginator
-from django.db.models.functions import datetime
-from django.http import JsonResponse
+from django.db import transaction
+from django.db.models import Prefetch
+from django.http import Http404, HttpResponseBadRequest, HttpResponseForbidden, JsonResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.template.loader import render_to_string
 from django.urls import reverse_lazy
 from django.utils.decorators import method_decorator
-from django.views.decorators.cache import cache_page
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 from django.views.generic import DetailView, FormView, ListView, UpdateView
 
-import requests
-
 from store.forms import ContactForm, OrderItemsForm, RegisterForm
 
-from .models import Book, Genre, Order, OrderItem
-from .tasks import contact_us_send_mail
+from .cart import get_cart
+from .catalog import cache_catalog_page, genres, request_catalog_version
+from .mail import queue_mail
+from .models import Author, Book, Genre, Order
+from .pagination import KeysetPage
+from .tasks import forward_order
 
 User = get_user_model()
 
@@ -54,31 +62,43 @@ class UpdateProfileView(LoginRequiredMixin, SuccessMessageMixin, UpdateView):
         return user
 
 
-@method_decorator(cache_page(5), name='dispatch')
+@method_decorator(cache_catalog_page, name='dispatch')
 class BookListView(ListView):
-    queryset = Book.objects.all().order_by('title')
+    # only the columns and relations the book cards show
+    queryset = Book.objects.only('id', 'title', 'summary').prefetch_related(
+        Prefetch('author', queryset=Author.objects.only('id', 'name'))
+    ).order_by('title', 'id')
     template_name = 'index.html'
     paginate_by = 10
 
+    def paginate_queryset(self, queryset, page_size):
+        page = KeysetPage(queryset, self.request.GET, page_size)
+        return None, page, page.object_list, page.has_next or page.has_previous
+
     def get_context_data(self, **kwargs):
         context = super(BookListView, self).get_context_data(**kwargs)
-        p = Paginator(Book.objects.all().order_by('title'), self.paginate_by)
-        context['articles'] = p.page(context['page_obj'].number)
-        context['genre_list'] = Genre.objects.all()
+        context['genre_list'] = genres.get(request_catalog_version(self.request))
 
         return context
 
 
-@cache_page(5)
+@cache_catalog_page
 def genre_detail(request, pk):
-    genre = get_object_or_404(Genre, pk=pk)
-    books = genre.book_set.all().order_by('title')
+    genre_list = genres.get(request_catalog_version(request))
+    genre = next((genre for genre in genre_list if genre.pk == pk), None)
+    if genre is None:
+        # added after this process loaded its genres
+        genre = get_object_or_404(Genre, pk=pk)
+    # only the columns and relations the book cards show
+    books = genre.book_set.only('id', 'title', 'summary', 'price', 'mark').prefetch_related(
+        Prefetch('author', queryset=Author.objects.only('id', 'name'))
+    ).order_by('title', 'id')
     paginator = Paginator(books, 10)
 
     page_number = request.GET.get('page')
     page_obj = paginator.get_page(page_number)
 
-    genre_list = Genre.objects.exclude(name=genre.name)
+    genre_list = [other for other in genre_list if other.name != genre.name]
 
     context = {
         'genre': genre,
@@ -89,7 +109,7 @@ def genre_detail(request, pk):
     return render(request, 'store/genre_detail_page.html', context)
 
 
-@method_decorator(cache_page(5), name='dispatch')
+@method_decorator(cache_catalog_page, name='dispatch')
 class BookDetailView(SuccessMessageMixin, DetailView):
     model = Book
     template_name = 'store/book_details.html'
@@ -104,7 +124,7 @@ def contact_form(request):
             from_email = form.cleaned_data['from_email']
             message = form.cleaned_data['message']
             data['form_is_valid'] = True
-            contact_us_send_mail.delay(subject, message, from_email, ['admin@example.com'])
+            queue_mail(subject, message, from_email, ['admin@example.com'])
             messages.add_message(request, messages.SUCCESS, 'Message sent')
         else:
             data['form_is_valid'] = False
@@ -117,102 +137,118 @@ def contact_form(request):
 
 @login_required
 def add_to_order(request, pk):
-    book = get_object_or_404(Book, pk=pk)
-    current_user = request.user
-    order, created = Order.objects.get_or_create(status=2, user=current_user,
-                                                 defaults={'user': current_user, 'comment': 'added automatically'})
-    if OrderItem.objects.filter(book=book, order=order).exists():
-        book_order_item = OrderItem.objects.get(book=book, order=order)
-        book_order_item.quantity += 1
-        book_order_item.save()
+    quantity = get_cart(request.user).add(pk)
+    if quantity is None:
+        raise Http404('No such book')
+    if quantity > 1:
         messages.success(request, "Item already in cart! We added increased books quantity to +1")
-        return redirect('index')
-        # return reverse_lazy('index')
     else:
-        OrderItem.objects.create(order=order, book=book)
         messages.success(request, "Item added to the cart!")
-        return redirect('index')
-        # return reverse_lazy('index')
+    return redirect('index')
 
 
 @login_required
 def order_items_list(request):
-    current_user = request.user
-    order, created = Order.objects.get_or_create(status=2, user=current_user,
-                                                 defaults={'user': current_user,
-                                                           'comment': 'added automatically'})
-    order_items = OrderItem.objects.filter(order__id=order.id)
-    return render(request, 'store/order_items_list.html', {'order': order, 'order_items': order_items})
+    cart = get_cart(request.user)
+    return render(request, 'store/order_items_list.html', {'order_items': cart.items(), 'totals': cart.totals()})
+
 
+def render_order_item_changes(request, cart, data, order_item=None, removed=()):
+    """Fills `data` with the changed cart row and totals, so the page patches them in instead of the whole list."""
+    data['order_item_id'] = order_item.pk if order_item is not None else None
+    data['html_order_item'] = render_to_string('includes/partial_order_item_row.html', {
+        'item': order_item
+    }, request=request) if order_item is not None else ''
+    data['removed_order_item_ids'] = list(removed)
+    data['html_order_totals'] = render_to_string('includes/partial_order_totals.html', {
+        'totals': cart.totals()
+    }, request=request)
 
-def save_order_item_form(request, form, template_name):
+
+def save_order_item_form(request, cart, form, template_name):
     data = dict()
     if request.method == 'POST':
         if form.is_valid():
-            form.save()
+            pk = form.instance.pk
+            saved_pk = cart.save_item(form.save(commit=False))
             data['form_is_valid'] = True
-            order = Order.objects.get(status=2, user=request.user)
-            order_items = OrderItem.objects.filter(order__id=order.id)
-            data['html_order_items_list'] = render_to_string('includes/partial_order_items_list.html', {
-                'order_items': order_items
-            })
-        else:
-            data['form_is_valid'] = False
+            render_order_item_changes(request, cart, data, cart.get_item(saved_pk),
+                                      removed=[pk] if saved_pk != pk else [])
+            return JsonResponse(data)
+        data['form_is_valid'] = False
     context = {'form': form}
     data['html_form'] = render_to_string(template_name, context=context, request=request)
     return JsonResponse(data)
 
 
+@login_required
 def order_item_update(request, pk):
-    order_item = get_object_or_404(OrderItem, pk=pk)
+    cart = get_cart(request.user)
+    order_item = cart.get_item(pk)
     if request.method == 'POST':
         form = OrderItemsForm(request.POST, instance=order_item)
     else:
         form = OrderItemsForm(instance=order_item)
-    return save_order_item_form(request, form, 'includes/partial_order_item_update.html')
+    return save_order_item_form(request, cart, form, 'includes/partial_order_item_update.html')
 
 
+@login_required
 def order_items_delete(request, pk):
-    order_item = get_object_or_404(OrderItem, pk=pk)
+    cart = get_cart(request.user)
+    order_item = cart.get_item(pk)
     data = dict()
     if request.method == 'POST':
-        order_item.delete()
+        cart.remove_item(order_item)
         data['form_is_valid'] = True
-        order = Order.objects.get(status=2, user=request.user)
-        order_items = OrderItem.objects.filter(order__id=order.id)
-        data['html_order_items_list'] = render_to_string('includes/partial_order_items_list.html', {
-            'order_items': order_items
-        })
+        render_order_item_changes(request, cart, data, removed=[pk])
     else:
         context = {'order_item': order_item}
         data['html_form'] = render_to_string('includes/partial_order_item_delete.html', context, request=request)
     return JsonResponse(data)
 
 
+@login_required
 def order_send(request):
-    url = 'http://warehouse:8002/orders/'
-    order = Order.objects.get(status=2, user=request.user)
-    order_items = OrderItem.objects.filter(order__id=order.id)
-
-    order_items_list = []
-    for record in order_items:
-        order_item = {
-            'id': record.id,
-            'book': str(record.book.id),
-            'quantity': record.quantity
-        }
-        order_items_list.append(order_item)
-    data = json.dumps(
-        {"id": str(order.id), "customer_mail": order.user.email,
-         "order_date": str(datetime.datetime.now().date()),
-         "order_items": order_items_list}
-    )
-    headers = {'Content-Type': 'application/json'}
-    response = requests.post(url=url, headers=headers, data=data)
-    if response.status_code == 201:
-        order.status = 3
-        order.save(update_fields=['status'])
-        messages.success(request, "Item added to the cart!")
-        return redirect('index')
-    else:
+    """Checks the cart out: the order is queued and forwarded to the warehouse in the background."""
+    if not request.user.email:
+        messages.warning(request, 'Please add an e-mail address to send the order')
         return redirect('update_profile')
+
+    order = get_cart(request.user).checkout()
+    if order is None:
+        messages.warning(request, 'Your cart is empty')
+        return redirect('order')
+    transaction.on_commit(partial(forward_order.delay, str(order.id)))
+    messages.success(request, 'Order sent!')
+    return redirect('index')
+
+
+@csrf_exempt
+@require_POST
+def order_status_callback(request):
+    """Applies order status changes reported by the warehouse: [{"id": <order id>, "status": <status>}]."""
+    token = settings.ORDER_CALLBACK_TOKEN
+    authorization = request.headers.get('Authorization', '').encode()
+    if not token or not hmac.compare_digest(authorization, f'Token {token}'.encode()):
+        return HttpResponseForbidden()
+    try:
+        changes = json.loads(request.body)
+        if isinstance(changes, dict):
+            changes = [changes]
+        by_status = {}
+        for change in changes:
+            by_status.setdefault(Order.OrderStatus(int(change['status'])), []).append(uuid.UUID(str(change['id'])))
+    except (ValueError, KeyError, TypeError):
+        return HttpResponseBadRequest('Expected a list of {"id", "status"} objects')
+    if set(by_status) - {Order.OrderStatus.DONE, Order.OrderStatus.REJECTED}:
+        return HttpResponseBadRequest('Only Done and Rejected statuses can be reported')
+
+    sent = [
+        Order.OrderStatus.QUEUED, Order.OrderStatus.FORWARDING, Order.OrderStatus.SENT,
+        Order.OrderStatus.DONE, Order.OrderStatus.REJECTED,
+    ]
+    updated = 0
+    with transaction.atomic():
+        for status, ids in by_status.items():
+            updated += Order.objects.filter(id__in=ids, status__in=sent).update(status=status)
+    return JsonResponse({'updated': updated})
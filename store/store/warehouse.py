@@ -0,0 +1,138 @@
+"""HTTP client for the warehouse API shared by every store -> warehouse call."""
+import threading
+import time
+from urllib.parse import urljoin
+
+from django.conf import settings
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from urllib3.util.retry import Retry
+
+
+class WarehouseUnavailable(requests.ConnectionError):
+    """Raised without calling the warehouse while the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive failures and lets a single trial call through after `reset_timeout`."""
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        return 'half-open' if time.monotonic() - self.opened_at >= self.reset_timeout else 'open'
+
+    def allow(self):
+        with self.lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self.trial:
+                self.trial = True
+                return True
+            return False
+
+    def record(self, success):
+        with self.lock:
+            self.trial = False
+            if success:
+                self.failures, self.opened_at = 0, None
+                return
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+class WarehouseClient:
+    """Keep-alive connection pool to the warehouse with timeouts, retries, a circuit breaker and metrics."""
+
+    def __init__(self, base_url=None, timeout=None, pool_size=None, retries=None, breaker_threshold=None,
+                 breaker_reset_timeout=None):
+        self.base_url = base_url or settings.WAREHOUSE_URL
+        self.timeout = timeout or (settings.WAREHOUSE_CONNECT_TIMEOUT, settings.WAREHOUSE_READ_TIMEOUT)
+        self.breaker = CircuitBreaker(
+            breaker_threshold or settings.WAREHOUSE_BREAKER_THRESHOLD,
+            breaker_reset_timeout or settings.WAREHOUSE_BREAKER_RESET_TIMEOUT,
+        )
+        retry = Retry(
+            total=settings.WAREHOUSE_RETRIES if retries is None else retries, backoff_factor=0.5,
+            status_forcelist=(502, 503, 504), raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size or settings.WAREHOUSE_POOL_SIZE, max_retries=retry
+        )
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'failures': 0, 'short_circuited': 0, 'seconds': 0.0, 'max_seconds': 0.0}
+
+    def url(self, path):
+        """Absolute URL of a warehouse API path; absolute URLs (e.g. `next` page links) are returned as is."""
+        return urljoin(self.base_url, path)
+
+    def request(self, method, path, **kwargs):
+        if not self.breaker.allow():
+            with self.lock:
+                self.stats['short_circuited'] += 1
+            raise WarehouseUnavailable(f'Warehouse circuit breaker is open ({self.breaker.failures} failures)')
+
+        kwargs.setdefault('timeout', self.timeout)
+        started = time.monotonic()
+        success = False
+        try:
+            response = self.session.request(method, self.url(path), **kwargs)
+            success = response.status_code < 500
+        finally:
+            # whatever the call raised, so a half-open trial always ends
+            self._record(started, success)
+        return response
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def metrics(self):
+        """Snapshot of this process' call counters, latency in seconds and breaker state."""
+        with self.lock:
+            metrics = dict(self.stats)
+        metrics['avg_seconds'] = round(metrics['seconds'] / metrics['requests'], 3) if metrics['requests'] else None
+        metrics['seconds'] = round(metrics['seconds'], 3)
+        metrics['max_seconds'] = round(metrics['max_seconds'], 3)
+        metrics['breaker'] = self.breaker.state
+        return metrics
+
+    def _record(self, started, success):
+        elapsed = time.monotonic() - started
+        self.breaker.record(success)
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['failures'] += not success
+            self.stats['seconds'] += elapsed
+            self.stats['max_seconds'] = max(self.stats['max_seconds'], elapsed)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """The process wide warehouse client, created on first use (so after a Celery worker forked)."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = WarehouseClient()
+    return _client
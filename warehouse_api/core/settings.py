@@ -150,6 +150,41 @@ STATIC_URL = '/static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+MAIL_RATE_LIMIT = float(os.environ.get('MAIL_RATE_LIMIT', 10))  # messages per second per worker, 0 for no limit
+
+# Book stock counters, see warehouse_api.models.BookStock
+STOCK_COUNTER_STRIPES = int(os.environ.get('STOCK_COUNTER_STRIPES', 8))  # rows per book that writers spread over
+
+# Catalog change events for the store, see warehouse_api.events
+CATALOG_EVENTS_BROKER_URL = os.environ.get('CATALOG_EVENTS_BROKER_URL', 'amqp://localhost:5672')
+CATALOG_EVENTS_EXCHANGE = 'warehouse.catalog'
+CATALOG_EVENTS_BATCH_SIZE = int(os.environ.get('CATALOG_EVENTS_BATCH_SIZE', 500))  # book ids per message
+
+# Celery Configuration Options
+CELERY_TIMEZONE = TIME_ZONE
+CELERY_TASK_TIME_LIMIT = 30 * 60
+CELERY_BROKER_URL = os.environ.get('CELERY_BROKER_URL', 'amqp://localhost:5672')
+CELERY_ACCEPT_CONTENT = ['application/json']
+CELERY_TASK_SERIALIZER = 'json'
+CELERY_TASK_IGNORE_RESULT = True
+
+# Order status notifications, relayed from the outbox to the store and the customers
+STORE_ORDERS_CALLBACK_URL = os.environ.get('STORE_ORDERS_CALLBACK_URL', 'http://store:8000/store/orders_api/')
+STORE_CALLBACK_TOKEN = os.environ.get('STORE_CALLBACK_TOKEN', '')  # the store's ORDER_CALLBACK_TOKEN
+STORE_CALLBACK_TIMEOUT = float(os.environ.get('STORE_CALLBACK_TIMEOUT', 10))  # seconds
+ORDER_OUTBOX_BATCH_SIZE = int(os.environ.get('ORDER_OUTBOX_BATCH_SIZE', 500))  # rows per store callback
+ORDER_OUTBOX_RELAY_INTERVAL = int(os.environ.get('ORDER_OUTBOX_RELAY_INTERVAL', 60))  # seconds, retries failures
+ORDER_OUTBOX_LEASE = int(os.environ.get('ORDER_OUTBOX_LEASE', 10 * 60))  # seconds a relay run may take for a batch
+ORDER_OUTBOX_RETRY_DELAY = int(os.environ.get('ORDER_OUTBOX_RETRY_DELAY', 60))  # seconds, doubled after each failure
+ORDER_OUTBOX_MAX_RETRY_DELAY = int(os.environ.get('ORDER_OUTBOX_MAX_RETRY_DELAY', 6 * 60 * 60))  # seconds
+ORDER_OUTBOX_MAX_ATTEMPTS = int(os.environ.get('ORDER_OUTBOX_MAX_ATTEMPTS', 20))  # then the row is left to an admin
+
+CELERY_BEAT_SCHEDULE = {
+    'relay-order-outbox': {
+        'task': 'warehouse_api.tasks.relay_order_outbox',
+        'schedule': ORDER_OUTBOX_RELAY_INTERVAL,
+    },
+}
 
 # django-rest-framework
 REST_FRAMEWORK = {
@@ -161,7 +196,7 @@ REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'rest_framework.authentication.TokenAuthentication',
     ],
-    'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
+    'DEFAULT_PAGINATION_CLASS': 'warehouse_api.pagination.KeysetPagination',
     'PAGE_SIZE': 10
 }
 
@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import Author, Book, BookInstance, Genre, Order, OrderItem
+from .models import Author, Book, BookInstance, Genre, Order, OrderItem, OrderOutbox
 
 
 @admin.register(Author)
@@ -21,12 +21,31 @@ class BooksInstanceInlineModelAdmin(admin.TabularInline):
 
 @admin.register(Book)
 class BookModelAdmin(admin.ModelAdmin):
-    list_display = ['title', 'display_genre', 'display_authors', 'price', 'mark']
+    list_display = ['title', 'display_genre', 'display_authors', 'price', 'mark', 'in_stock', 'reserved', 'sold']
     search_fields = ['title']
     list_filter = ['mark', 'author', 'genre']
     filter_horizontal = ['author', 'genre']  # many-to-many relationship widget
     inlines = [BooksInstanceInlineModelAdmin]  # allows you to edit related objects on the same page as the parent obj.
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate_stock()
+
+    def in_stock(self, book):
+        return book.in_stock
+
+    in_stock.short_description = 'In stock'
+    in_stock.admin_order_field = 'in_stock'
+
+    def reserved(self, book):
+        return book.reserved
+
+    reserved.admin_order_field = 'reserved'
+
+    def sold(self, book):
+        return book.sold
+
+    sold.admin_order_field = 'sold'
+
 
 @admin.register(BookInstance)
 class BookInstanceModelAdmin(admin.ModelAdmin):
@@ -72,3 +91,9 @@ class OrderModelAdmin(admin.ModelAdmin):
 class OrderItemModelAdmin(admin.ModelAdmin):
     list_display = ['order', 'book', 'quantity']
     inlines = [BooksInstanceInlineModelAdmin]
+
+
+@admin.register(OrderOutbox)
+class OrderOutboxModelAdmin(admin.ModelAdmin):
+    list_display = ['order', 'status', 'created', 'store_notified', 'mailed', 'attempts', 'next_try', 'claimed_at']
+    list_filter = ['status']
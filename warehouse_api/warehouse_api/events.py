@@ -0,0 +1,64 @@
+"""Catalog change events, published to the message broker once the transaction that made them commits."""
+import logging
+import threading
+
+from django.conf import settings
+from django.db import transaction
+
+from kombu import Connection, Exchange
+from kombu.pools import producers
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+def _chunked(ids, size):
+    ids = sorted(ids)
+    return [ids[start:start + size] for start in range(0, len(ids), size)]
+
+
+class EventBatch:
+    def __init__(self):
+        self.changed, self.deleted = set(), set()
+
+    def messages(self):
+        size = settings.CATALOG_EVENTS_BATCH_SIZE
+        for ids in _chunked(self.changed - self.deleted, size):
+            yield 'book.changed', {'ids': ids}
+        for ids in _chunked(self.deleted, size):
+            yield 'book.deleted', {'ids': ids}
+
+    def publish(self):
+        exchange = Exchange(settings.CATALOG_EVENTS_EXCHANGE, type='topic', durable=True)
+        try:
+            connection = Connection(settings.CATALOG_EVENTS_BROKER_URL, connect_timeout=2)
+            with producers[connection].acquire(block=True, timeout=5) as producer:
+                for routing_key, body in self.messages():
+                    # retried briefly, this runs right after the commit of a request
+                    producer.publish(
+                        body, exchange=exchange, routing_key=routing_key, declare=[exchange], serializer='json',
+                        delivery_mode='persistent', retry=True,
+                        retry_policy={'max_retries': 2, 'interval_start': 0, 'interval_step': 0.2},
+                    )
+        except Exception:
+            # the change is committed already; the store's periodic book_sync picks it up instead
+            logger.exception('Could not publish catalog events')
+
+
+def record(kind, book_ids):
+    """Adds book ids to the `changed` or `deleted` events of the current transaction."""
+    book_ids = {book_id for book_id in book_ids if book_id is not None}
+    if not book_ids:
+        return
+    connection = transaction.get_connection()
+    batch = getattr(_local, 'batch', None)
+    # a batch is reused while its publish callback waits for the same transaction to commit
+    pending = batch is not None and connection.in_atomic_block and any(
+        callback[1] == batch.publish for callback in connection.run_on_commit
+    )
+    if not pending:
+        batch = _local.batch = EventBatch()
+    getattr(batch, kind).update(book_ids)
+    if not pending:
+        transaction.on_commit(batch.publish)
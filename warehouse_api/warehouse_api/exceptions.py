@@ -0,0 +1,19 @@
+from rest_framework import status
+from rest_framework.exceptions import APIException, ErrorDetail
+
+
+class OutOfStock(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'Not enough copies in stock.'
+    default_code = 'out_of_stock'
+
+    def __init__(self, shortages):
+        super().__init__()
+        # set directly, APIException would turn the numbers of the shortages into strings
+        self.detail = {'detail': ErrorDetail(self.default_detail, self.default_code), 'order_items': shortages}
+
+
+class IdempotencyKeyReused(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'Idempotency-Key was already used for another order or request body.'
+    default_code = 'idempotency_key_reused'
@@ -0,0 +1,31 @@
+"""Customer e-mails of the order outbox relay, sent over one SMTP connection per relay batch."""
+import logging
+import smtplib
+import time
+
+from django.conf import settings
+from django.core.mail import get_connection
+
+logger = logging.getLogger(__name__)
+
+# errors of the message itself, it would fail the same way on the next relay run
+MESSAGE_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError, ValueError)
+
+
+def send_batch(messages):
+    """Sends EmailMessages, at most MAIL_RATE_LIMIT a second, until the connection fails; returns how many are done."""
+    done = 0
+    interval = 1 / settings.MAIL_RATE_LIMIT if settings.MAIL_RATE_LIMIT else 0
+    try:
+        with get_connection(fail_silently=False) as connection:
+            for message in messages:
+                if done:
+                    time.sleep(interval)
+                try:
+                    connection.send_messages([message])
+                except MESSAGE_ERRORS:
+                    logger.exception('Could not mail %s, dropped', ', '.join(message.to))
+                done += 1
+    except (smtplib.SMTPException, OSError):
+        logger.exception('Mailed %s of %s, the rest is left to the next relay run', done, len(messages))
+    return done
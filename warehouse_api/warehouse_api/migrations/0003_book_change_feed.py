@@ -0,0 +1,29 @@
+# Generated by Django 3.2.6 on 2026-10-18 07:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('warehouse_api', '0002_auto_20210824_2106'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeletedBook',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('book_id', models.BigIntegerField(help_text='ID of the deleted book')),
+                ('deleted', models.DateTimeField(auto_now_add=True, db_index=True, help_text='Date when book was deleted')),
+            ],
+            options={
+                'ordering': ['deleted'],
+            },
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='updated',
+            field=models.DateTimeField(auto_now=True, db_index=True, help_text='Last time the book was changed'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.2.6 on 2026-10-18 07:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('warehouse_api', '0003_book_change_feed'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='book',
+            name='updated',
+            field=models.DateTimeField(auto_now=True, help_text='Last time the book was changed'),
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['title', 'id'], name='warehouse_a_title_809171_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['updated', 'id'], name='warehouse_a_updated_850895_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['-order_date', 'id'], name='warehouse_a_order_d_5a82d4_idx'),
+        ),
+    ]
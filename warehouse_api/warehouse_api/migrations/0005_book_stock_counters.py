@@ -0,0 +1,47 @@
+# Generated by Django 3.2.6 on 2026-10-18 07:56
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def fill_stock_counters(apps, schema_editor):
+    Book = apps.get_model('warehouse_api', 'Book')
+    BookInstance = apps.get_model('warehouse_api', 'BookInstance')
+    fields = {1: 'in_stock', 2: 'reserved', 3: 'sold'}
+
+    counters = {}
+    copies = BookInstance.objects.filter(book__isnull=False, status__in=fields).values('book', 'status')
+    for row in copies.annotate(copies=Count('id')).order_by():
+        counters.setdefault(row['book'], {})[fields[row['status']]] = row['copies']
+
+    books = list(Book.objects.filter(id__in=counters))
+    for book in books:
+        for field, value in counters[book.id].items():
+            setattr(book, field, value)
+    Book.objects.bulk_update(books, list(fields.values()), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('warehouse_api', '0004_keyset_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='in_stock',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Copies in stock'),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='reserved',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Reserved copies'),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='sold',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Sold copies'),
+        ),
+        migrations.RunPython(fill_stock_counters, migrations.RunPython.noop),
+    ]
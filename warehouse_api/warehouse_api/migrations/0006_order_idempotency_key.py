@@ -0,0 +1,18 @@
+# Generated by Django 3.2.6 on 2026-10-18 08:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('warehouse_api', '0005_book_stock_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='idempotency_key',
+            field=models.CharField(blank=True, editable=False, help_text='Idempotency-Key header of the request that created the order', max_length=255, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.2.6 on 2026-10-18 08:15
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('warehouse_api', '0006_order_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderOutbox',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.PositiveSmallIntegerField(choices=[(1, 'Waiting'), (2, 'In progress'), (3, 'Done'), (4, 'Rejected')], help_text='New order status')),
+                ('created', models.DateTimeField(help_text='Date when the status changed')),
+                ('store_notified', models.DateTimeField(blank=True, help_text='Date when the store was told', null=True)),
+                ('mailed', models.DateTimeField(blank=True, help_text='Date when the customer was e-mailed', null=True)),
+                ('attempts', models.PositiveIntegerField(default=0, help_text='Failed delivery attempts')),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='warehouse_api.order')),
+            ],
+            options={
+                'verbose_name_plural': 'order outbox',
+                'ordering': ['id'],
+            },
+        ),
+    ]
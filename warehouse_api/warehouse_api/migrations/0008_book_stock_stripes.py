@@ -0,0 +1,62 @@
+# Generated by Django 3.2.6 on 2026-10-18 08:35
+
+from django.db import migrations, models
+from django.db.models import Sum
+import django.db.models.deletion
+
+FIELDS = ['in_stock', 'reserved', 'sold']
+
+
+def move_counters_to_stripes(apps, schema_editor):
+    Book = apps.get_model('warehouse_api', 'Book')
+    BookStock = apps.get_model('warehouse_api', 'BookStock')
+    BookStock.objects.bulk_create([
+        BookStock(book_id=book['id'], stripe=0, **{field: book[field] for field in FIELDS})
+        for book in Book.objects.exclude(in_stock=0, reserved=0, sold=0).values('id', *FIELDS).iterator()
+    ], batch_size=500)
+
+
+def sum_stripes_into_counters(apps, schema_editor):
+    Book = apps.get_model('warehouse_api', 'Book')
+    BookStock = apps.get_model('warehouse_api', 'BookStock')
+    totals = BookStock.objects.values('book').annotate(**{field: Sum(field) for field in FIELDS}).order_by()
+    books = [Book(id=row['book'], **{field: row[field] for field in FIELDS}) for row in totals]
+    Book.objects.bulk_update(books, FIELDS, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('warehouse_api', '0007_order_outbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookStock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stripe', models.PositiveSmallIntegerField()),
+                ('in_stock', models.IntegerField(default=0, help_text='Change of copies in stock')),
+                ('reserved', models.IntegerField(default=0, help_text='Change of reserved copies')),
+                ('sold', models.IntegerField(default=0, help_text='Change of sold copies')),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='warehouse_api.book')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='bookstock',
+            constraint=models.UniqueConstraint(fields=('book', 'stripe'), name='warehouse_api_bookstock_unique_stripe'),
+        ),
+        migrations.RunPython(move_counters_to_stripes, sum_stripes_into_counters),
+        migrations.RemoveField(
+            model_name='book',
+            name='in_stock',
+        ),
+        migrations.RemoveField(
+            model_name='book',
+            name='reserved',
+        ),
+        migrations.RemoveField(
+            model_name='book',
+            name='sold',
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.6 on 2026-10-18 09:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('warehouse_api', '0008_book_stock_stripes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderoutbox',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, help_text='Start of the relay lease on the row', null=True),
+        ),
+    ]
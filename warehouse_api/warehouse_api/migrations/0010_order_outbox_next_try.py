@@ -0,0 +1,18 @@
+# Generated by Django 3.2.6 on 2026-10-18 15:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('warehouse_api', '0009_order_outbox_lease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderoutbox',
+            name='next_try',
+            field=models.DateTimeField(blank=True, help_text='Date before which a failed row is not retried', null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.6 on 2026-10-18 16:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('warehouse_api', '0010_order_outbox_next_try'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='idempotency_fingerprint',
+            field=models.CharField(blank=True, editable=False, help_text='Digest of the request body sent with the Idempotency-Key', max_length=64),
+        ),
+    ]
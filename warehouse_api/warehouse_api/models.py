@@ -1,11 +1,20 @@
+import os
+import threading
 import uuid
+from collections import Counter
 
-# import requests
-# from django.core.mail import send_mail
+from django.conf import settings
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db import models
+from django.db import connections, models, transaction
+from django.db.models import Count, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
 
-from django_lifecycle import LifecycleModelMixin  # hook, AFTER_UPDATE
+from django_lifecycle import AFTER_CREATE, AFTER_UPDATE, LifecycleModelMixin, hook
+
+from . import events
 
 
 class Author(models.Model):
@@ -25,6 +34,32 @@ class Genre(models.Model):
         return self.name
 
 
+class BookQuerySet(models.QuerySet):
+    def update(self, **kwargs):
+        # auto_now only applies to save(), and the change feed must see bulk changes too
+        kwargs.setdefault('updated', timezone.now())
+        return super().update(**kwargs)
+
+    def touch(self):
+        """Moves the books to the head of the change feed, for changes outside their own row (authors, genres)."""
+        return self.update()
+
+    def annotate_stock(self):
+        """Sums the stock counter stripes of each book into in_stock, reserved and sold."""
+        stripes = BookStock.objects.filter(book=OuterRef('pk')).order_by().values('book')
+        return self.annotate(**{
+            field: Coalesce(Subquery(stripes.annotate(total=Sum(field)).values('total')), 0)
+            for field in STOCK_FIELDS.values()
+        })
+
+    def annotate_counted_stock(self):
+        """Counts copies by sell status with a grouped query (counted_in_stock, counted_reserved, counted_sold)."""
+        return self.annotate(**{
+            f'counted_{field}': Count('bookinstance', filter=Q(bookinstance__status=status))
+            for status, field in STOCK_FIELDS.items()
+        })
+
+
 class Book(models.Model):
     """Model representing a book (but not a specific copy of a book)."""
     # id = models.UUIDField(primary_key=True, default=uuid.uuid4,
@@ -35,9 +70,18 @@ class Book(models.Model):
     genre = models.ManyToManyField(Genre, verbose_name='genre')
     price = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     mark = models.FloatField(validators=[MinValueValidator(1), MaxValueValidator(5)])
+    # stock changes don't move a book in the change feed, they are read from /books/stock/
+    updated = models.DateTimeField(auto_now=True, help_text='Last time the book was changed')
+
+    objects = BookQuerySet.as_manager()
 
     class Meta:
         ordering = ['title']
+        indexes = [
+            # keyset pagination orderings of the books list and of its change feed
+            models.Index(fields=['title', 'id']),
+            models.Index(fields=['updated', 'id']),
+        ]
 
     def __str__(self):
         return self.title
@@ -55,6 +99,112 @@ class Book(models.Model):
     display_genre.short_description = 'Genres'
 
 
+class BookStockQuerySet(models.QuerySet):
+    def add(self, per_book, stripe, batch_size=500):
+        """Adds {book_id: {field: delta}} to one stripe of the books' counters, an upsert per `batch_size` books."""
+        connection = connections[self.db]
+        quote = connection.ops.quote_name
+        table, fields = quote(self.model._meta.db_table), [quote(field) for field in STOCK_FIELDS.values()]
+        book_table = quote(Book._meta.db_table)
+        book_pk = f'{book_table}.{quote(Book._meta.pk.column)}'
+        rows = sorted(per_book.items())
+        with connection.cursor() as cursor:
+            for start in range(0, len(rows), batch_size):
+                batch = rows[start:start + batch_size]
+                cursor.execute(
+                    f'INSERT INTO {table} (book_id, stripe, {", ".join(fields)}) '
+                    f'SELECT {book_pk}, %s, changes.column2, changes.column3, changes.column4 '
+                    f'FROM (VALUES {", ".join(["(%s, %s, %s, %s)"] * len(batch))}) AS changes, {book_table} '
+                    f'WHERE {book_pk} = changes.column1 ORDER BY {book_pk} '
+                    f'ON CONFLICT (book_id, stripe) DO UPDATE SET '
+                    f'{", ".join(f"{field} = {table}.{field} + EXCLUDED.{field}" for field in fields)}',
+                    [stripe] + [value for book_id, deltas in batch for value in (
+                        book_id, *(deltas.get(field, 0) for field in STOCK_FIELDS.values())
+                    )],
+                )
+
+
+class BookStock(models.Model):
+    """Stock counters of a book, split into up to STOCK_COUNTER_STRIPES rows; only their sums are meaningful."""
+    book = models.ForeignKey(Book, on_delete=models.CASCADE)
+    stripe = models.PositiveSmallIntegerField()
+    in_stock = models.IntegerField(default=0, help_text='Change of copies in stock')
+    reserved = models.IntegerField(default=0, help_text='Change of reserved copies')
+    sold = models.IntegerField(default=0, help_text='Change of sold copies')
+
+    objects = BookStockQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['book', 'stripe'], name='warehouse_api_bookstock_unique_stripe'),
+        ]
+
+    def __str__(self):
+        return f'{self.book_id}/{self.stripe}'
+
+
+class DeletedBook(models.Model):
+    """Tombstone of a deleted book, so that the store can drop it on the next delta sync."""
+    book_id = models.BigIntegerField(help_text='ID of the deleted book')
+    deleted = models.DateTimeField(auto_now_add=True, db_index=True, help_text='Date when book was deleted')
+
+    class Meta:
+        ordering = ['deleted']
+
+    def __str__(self):
+        return f'{self.book_id}'
+
+
+@receiver(post_delete, sender=Book)
+def book_deleted(sender, instance, **kwargs):
+    # post_delete is sent for queryset (admin bulk) deletes as well, unlike lifecycle hooks
+    DeletedBook.objects.create(book_id=instance.id)
+    events.record('deleted', [instance.id])
+
+
+@receiver(post_save, sender=Book)
+def book_saved(sender, instance, **kwargs):
+    events.record('changed', [instance.id])
+
+
+@receiver(m2m_changed, sender=Book.author.through)
+@receiver(m2m_changed, sender=Book.genre.through)
+def book_relations_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse:
+        # from the author/genre side the books are in pk_set, except for clear(), which only has them beforehand
+        if action == 'pre_clear':
+            book_ids = list(instance.book_set.values_list('id', flat=True))
+        elif action in ('post_add', 'post_remove'):
+            book_ids = pk_set
+        else:
+            return
+    elif action.startswith('post_'):
+        book_ids = [instance.id]
+    else:
+        return
+    Book.objects.filter(id__in=book_ids).touch()
+    events.record('changed', book_ids)
+
+
+@receiver(post_save, sender=Author)
+@receiver(post_save, sender=Genre)
+def book_names_changed(sender, instance, created, **kwargs):
+    if not created:
+        instance.book_set.all().touch()
+        events.record('changed', instance.book_set.values_list('id', flat=True))
+
+
+class OrderQuerySet(models.QuerySet):
+    """Writes the outbox rows of bulk status changes (admin actions), which bypass save() hooks."""
+
+    def update(self, **kwargs):
+        if kwargs.get('status') not in Order.NOTIFY_STATUSES:
+            return super().update(**kwargs)
+        with transaction.atomic(using=self.db):
+            OrderOutbox.objects.record(self.exclude(status=kwargs['status']), kwargs['status'])
+            return super().update(**kwargs)
+
+
 class Order(LifecycleModelMixin, models.Model):
     class OrderStatus(models.IntegerChoices):
         WAITING = 1, 'Waiting'
@@ -62,6 +212,9 @@ class Order(LifecycleModelMixin, models.Model):
         DONE = 3, 'Done'
         REJECTED = 4, 'Rejected'
 
+    # changes to these statuses are reported to the store and the customer, see OrderOutbox
+    NOTIFY_STATUSES = (OrderStatus.DONE, OrderStatus.REJECTED)
+
     id = models.UUIDField(  # noqa: A003
         primary_key=True, default=uuid.uuid4, help_text='Unique ID for this order across whole store'
     )
@@ -73,36 +226,73 @@ class Order(LifecycleModelMixin, models.Model):
         choices=OrderStatus.choices, default=OrderStatus.WAITING, help_text='Order status'
     )
     comment = models.CharField(max_length=20, blank=True)
+    idempotency_key = models.CharField(
+        max_length=255, unique=True, null=True, blank=True, editable=False,
+        help_text='Idempotency-Key header of the request that created the order'
+    )
+    idempotency_fingerprint = models.CharField(
+        max_length=64, blank=True, editable=False, help_text='Digest of the request body sent with the Idempotency-Key'
+    )
+
+    objects = OrderQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-order_date', 'id']),  # keyset pagination ordering of the orders list
+        ]
 
     def __str__(self):
         return f'{self.id}'
 
-    # @hook(AFTER_UPDATE, when='status', changes_to=3)
-    # def order_status_done_email(self):
-    #     send_mail(
-    #         subject="Your order was Done",
-    #         message="Your order was Done",
-    #         from_email="admin@admin.com", This will have no effect is you have set DEFAULT_FROM_EMAIL in settings.py
-    #         recipient_list=[f'{self.customer_mail}', ],  # This is a list
-    #         fail_silently=False  # Set this to False so that you will be noticed in any exception raised
-    #     )
-    #
-    #     url = 'http://store:8000/store/orders_api/'
-    #     requests.post(url=url, json={'id': f'{self.id}', 'status': 4})
-    #
-    # @hook(AFTER_UPDATE, when='status', changes_to=4)
-    # def order_status_rejected_email(self):
-    #     from django.core.mail import send_mail
-    #
-    #     send_mail(
-    #         subject="Your order was rejected",
-    #         message="Your order was rejected",
-    #         from_email="admin@admin.com",  This will have no effect is you have set DEFAULT_FROM_EMAIL in settings.py
-    #         recipient_list=[f'{self.customer_mail}'],  # This is a list
-    #         fail_silently=False  # Set this to False so that you will be noticed in any exception raised
-    #     )
-    #     url = 'http://store:8000/store/orders_api/'
-    #     requests.post(url=url, json={'id': f'{self.id}', 'status': 5})
+    def save(self, *args, **kwargs):
+        # the outbox row of a status change commits or rolls back together with it
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
+    @hook(AFTER_UPDATE, when='status', has_changed=True)
+    def notify_status_change(self):
+        if self.status in self.NOTIFY_STATUSES:
+            OrderOutbox.objects.record(Order.objects.filter(pk=self.pk), self.status)
+
+
+class OrderOutboxQuerySet(models.QuerySet):
+    def record(self, orders, status):
+        """Adds an outbox row for each order of the `orders` queryset with one INSERT ... SELECT."""
+        connection = connections[self.db]
+        sql, params = orders.values('id').query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {self.model._meta.db_table} (order_id, status, created, attempts) '
+                f'SELECT id, %s, %s, 0 FROM ({sql}) AS changed',
+                [status, connection.ops.adapt_datetimefield_value(timezone.now()), *params],
+            )
+            recorded = cursor.rowcount
+        if recorded:
+            from .tasks import schedule_outbox_relay
+
+            transaction.on_commit(schedule_outbox_relay, using=self.db)
+        return recorded
+
+
+class OrderOutbox(models.Model):
+    """Order status change waiting to be reported to the store and e-mailed to the customer."""
+    order = models.ForeignKey(Order, on_delete=models.CASCADE)
+    status = models.PositiveSmallIntegerField(choices=Order.OrderStatus.choices, help_text='New order status')
+    created = models.DateTimeField(help_text='Date when the status changed')
+    store_notified = models.DateTimeField(null=True, blank=True, help_text='Date when the store was told')
+    mailed = models.DateTimeField(null=True, blank=True, help_text='Date when the customer was e-mailed')
+    attempts = models.PositiveIntegerField(default=0, help_text='Failed delivery attempts')
+    claimed_at = models.DateTimeField(null=True, blank=True, help_text='Start of the relay lease on the row')
+    next_try = models.DateTimeField(null=True, blank=True, help_text='Date before which a failed row is not retried')
+
+    objects = OrderOutboxQuerySet.as_manager()
+
+    class Meta:
+        ordering = ['id']
+        verbose_name_plural = 'order outbox'
+
+    def __str__(self):
+        return f'{self.order_id}: {self.get_status_display()}'
 
 
 class OrderItem(models.Model):
@@ -114,7 +304,79 @@ class OrderItem(models.Model):
         return f'{self.id}'
 
 
-class BookInstance(models.Model):
+def stock_stripe():
+    """The stock counter stripe of this process/thread."""
+    return hash((os.getpid(), threading.get_ident())) % settings.STOCK_COUNTER_STRIPES
+
+
+def adjust_stock(changes):
+    """Applies {(book_id, status): delta} changes to the stock counters of the books, in one upsert."""
+    per_book = {}
+    for (book_id, status), delta in changes.items():
+        if book_id is not None and status in STOCK_FIELDS and delta:
+            deltas = per_book.setdefault(book_id, {})
+            deltas[STOCK_FIELDS[status]] = deltas.get(STOCK_FIELDS[status], 0) + delta
+    per_book = {book_id: deltas for book_id, deltas in per_book.items() if any(deltas.values())}
+    if per_book:
+        BookStock.objects.add(per_book, stock_stripe())
+
+
+def lock_stock(book_ids):
+    """Locks this thread's counter stripes of the books in id order; has to run inside a transaction."""
+    BookStock.objects.add({book_id: {} for book_id in book_ids}, stock_stripe())
+
+
+class BookInstanceQuerySet(models.QuerySet):
+    """Keeps the Book stock counters right on bulk paths, which bypass save() hooks."""
+
+    def bulk_create(self, objs, *args, **kwargs):
+        with transaction.atomic(using=self.db):
+            objs = super().bulk_create(objs, *args, **kwargs)
+            adjust_stock(Counter((obj.book_id, obj.status) for obj in objs))
+        return objs
+
+    def update(self, **kwargs):
+        if not {'book', 'book_id', 'status'} & kwargs.keys():
+            return super().update(**kwargs)
+        new_book = kwargs.get('book_id', kwargs.get('book'))
+        if isinstance(new_book, models.Model):
+            new_book = new_book.pk
+        with transaction.atomic(using=self.db):
+            rows = list(self.select_for_update().values_list('book_id', 'status'))
+            updated = super().update(**kwargs)
+            changes = Counter()
+            for book_id, status in rows:
+                changes[book_id, status] -= 1
+                changes[
+                    new_book if {'book', 'book_id'} & kwargs.keys() else book_id,
+                    kwargs.get('status', status),
+                ] += 1
+            adjust_stock(changes)
+        return updated
+
+    def reserve(self, order_item):
+        """Reserves up to `order_item.quantity` in-stock copies of its book for it, returns how many it got."""
+        # skip copies a concurrent reservation holds rather than queue behind it
+        copies = list(
+            self.select_for_update(skip_locked=True)
+            .filter(book_id=order_item.book_id, status=BookInstance.SellStatus.IN_STOCK)
+            .values_list('id', flat=True)[:order_item.quantity]
+        )
+        if copies:
+            self.filter(id__in=copies).update(status=BookInstance.SellStatus.RESERVED, order_item=order_item)
+        return len(copies)
+
+    def reserve_for(self, order_items):
+        """Reserves stock for every order item, returns the shortages as [{'book', 'requested', 'available'}]."""
+        shortages = []
+        for order_item in sorted(order_items, key=lambda item: item.book_id):
+            reserved = self.reserve(order_item)
+            if reserved < order_item.quantity:
+                shortages.append({'book': order_item.book_id, 'requested': order_item.quantity, 'available': reserved})
+        return shortages
+
+
+class BookInstance(LifecycleModelMixin, models.Model):
     """Model representing a specific copy of a book (i.e. that can be borrowed from the library)."""
 
     class SellStatus(models.IntegerChoices):
@@ -132,5 +394,31 @@ class BookInstance(models.Model):
         choices=SellStatus.choices, default=SellStatus.IN_STOCK, blank=True, help_text='Book status'
     )
 
+    objects = BookInstanceQuerySet.as_manager()
+
     def __str__(self):
         return f'{self.id} ({self.book.title})'
+
+    @hook(AFTER_CREATE)
+    def add_to_stock(self):
+        adjust_stock({(self.book_id, self.status): 1})
+
+    @hook(AFTER_UPDATE, when_any=['book', 'status'], has_changed=True)
+    def move_in_stock(self):
+        changes = Counter()
+        changes[self.initial_value('book'), self.initial_value('status')] -= 1
+        changes[self.book_id, self.status] += 1
+        adjust_stock(changes)
+
+
+STOCK_FIELDS = {
+    BookInstance.SellStatus.IN_STOCK: 'in_stock',
+    BookInstance.SellStatus.RESERVED: 'reserved',
+    BookInstance.SellStatus.SOLD: 'sold',
+}
+
+
+@receiver(post_delete, sender=BookInstance)
+def book_instance_deleted(sender, instance, **kwargs):
+    # covers queryset deletes and cascades from OrderItem as well
+    adjust_stock({(instance.book_id, instance.status): -1})
@@ -1,6 +1,14 @@
+from django.db import transaction
+
 from rest_framework import serializers
 
-from .models import Author, Book, BookInstance, Genre, Order, OrderItem
+from .exceptions import OutOfStock
+from .models import Author, Book, BookInstance, DeletedBook, Genre, Order, OrderItem
+
+
+def include_instances(request):
+    """Whether to nest every BookInstance of a book (`?instances=false` drops them, see `/books/stock/`)."""
+    return request.query_params.get('instances', '').lower() not in ('false', '0')
 
 
 class AuthorSerializer(serializers.HyperlinkedModelSerializer):
@@ -27,7 +35,14 @@ class OrderItemSerializer(serializers.HyperlinkedModelSerializer):
         fields = ['url', 'id', 'order', 'book', 'quantity']
 
 
-class BookSerializer(serializers.HyperlinkedModelSerializer):
+class StockSerializerMixin(serializers.Serializer):
+    """Stock counters annotated by BookQuerySet.annotate_stock() (0 for a book that was just created)."""
+    in_stock = serializers.IntegerField(read_only=True, default=0)
+    reserved = serializers.IntegerField(read_only=True, default=0)
+    sold = serializers.IntegerField(read_only=True, default=0)
+
+
+class BookSerializer(StockSerializerMixin, serializers.HyperlinkedModelSerializer):
     books = BookInstanceSerializer(source='bookinstance_set', many=True)
     author = GenreSerializer(read_only=True, many=True)
     genre = GenreSerializer(read_only=True, many=True)
@@ -35,21 +50,75 @@ class BookSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
         many = True
         model = Book
-        fields = ['url', 'id', 'title', 'author', 'summary', 'genre', 'price', 'mark', 'books']
+        fields = [
+            'url', 'id', 'title', 'author', 'summary', 'genre', 'price', 'mark', 'updated',
+            'in_stock', 'reserved', 'sold', 'books',
+        ]
+
+    def get_fields(self):
+        fields = super().get_fields()
+        request = self.context.get('request')
+        if request is not None and not include_instances(request):
+            del fields['books']
+        return fields
+
+
+class BookStockSerializer(StockSerializerMixin, serializers.ModelSerializer):
+    class Meta:
+        model = Book
+        fields = ['id', 'in_stock', 'reserved', 'sold']
+
+
+class DeletedBookSerializer(serializers.ModelSerializer):
+    id = serializers.IntegerField(source='book_id')  # noqa: A003
+
+    class Meta:
+        model = DeletedBook
+        fields = ['id', 'deleted']
+
+
+class BookIdField(serializers.PrimaryKeyRelatedField):
+    """Book given by id; batch requests preload all their books into the `books` context entry."""
+
+    def to_internal_value(self, data):
+        books = self.context.get('books')
+        if books is None:
+            return super().to_internal_value(data)
+        try:
+            return books[int(data)]
+        except (KeyError, TypeError, ValueError):
+            self.fail('does_not_exist', pk_value=data)
+
+
+class OrderItemInOrderSerializer(OrderItemSerializer):
+    """Order item nested in an order; the book is given by id, as the store sends it."""
+    book = BookIdField(queryset=Book.objects.all())
+    quantity = serializers.IntegerField(min_value=1, default=1)
+
+    class Meta(OrderItemSerializer.Meta):
+        fields = ['url', 'id', 'book', 'quantity']
 
 
 class OrderSerializer(serializers.HyperlinkedModelSerializer):
-    order_items = OrderItemSerializer(source='orderitem_set', many=True)
+    order_items = OrderItemInOrderSerializer(source='orderitem_set', many=True)
 
     class Meta:
         model = Order
         fields = ['url', 'id', 'customer_mail', 'customer_name', 'order_date', 'shipped_date', 'status', 'order_items']
 
+    @transaction.atomic
     def create(self, validated_data):
+        """Creates the order and reserves in-stock copies for its items; nothing is kept if any book is short."""
         order_items_validated_data = validated_data.pop('orderitem_set')
         order = Order.objects.create(**validated_data)
-        order_items_serializer = self.fields['order_items']
-        for each in order_items_validated_data:
-            each['order'] = order
-        order_items_serializer.create(order_items_validated_data)
-        return order, order_items_validated_data
+        order_items = [OrderItem.objects.create(order=order, **each) for each in order_items_validated_data]
+
+        shortages = BookInstance.objects.reserve_for(order_items)
+        if shortages:
+            raise OutOfStock(shortages)
+        return order
+
+
+class BulkOrderSerializer(OrderSerializer):
+    """Validates one order of a batch; the batch checks for already existing ids in a single query instead."""
+    id = serializers.UUIDField(required=False)  # noqa: A003
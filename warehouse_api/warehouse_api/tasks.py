@@ -0,0 +1,131 @@
+import logging
+import time
+from datetime import timedelta
+
+from celery import shared_task
+
+from django.conf import settings
+from django.core.mail import EmailMessage
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+import requests
+
+from .mail import send_batch
+from .models import Order, OrderOutbox
+
+logger = logging.getLogger(__name__)
+
+# warehouse status -> store.models.Order.OrderStatus
+STORE_STATUSES = {Order.OrderStatus.DONE: 4, Order.OrderStatus.REJECTED: 5}
+MAIL_SUBJECTS = {Order.OrderStatus.DONE: 'Your order was Done', Order.OrderStatus.REJECTED: 'Your order was rejected'}
+
+
+def schedule_outbox_relay():
+    """Starts the relay right after a status change commits; the periodic run covers an unavailable broker."""
+    try:
+        relay_order_outbox.delay()
+    except Exception:
+        logger.exception('Could not start the order outbox relay')
+
+
+def notify_store(rows):
+    """Reports the new statuses of a batch to the store in one callback; returns whether it was accepted."""
+    headers = {'Authorization': f'Token {settings.STORE_CALLBACK_TOKEN}'} if settings.STORE_CALLBACK_TOKEN else {}
+    try:
+        response = requests.post(
+            settings.STORE_ORDERS_CALLBACK_URL, headers=headers, timeout=settings.STORE_CALLBACK_TIMEOUT,
+            json=[{'id': str(row.order_id), 'status': STORE_STATUSES[row.status]} for row in rows],
+        )
+        response.raise_for_status()
+    except requests.RequestException:
+        logger.exception('Store callback for %s orders failed', len(rows))
+        return False
+    return True
+
+
+def mail_customers(rows):
+    """E-mails the customers of a batch over one connection; returns the rows that were mailed."""
+    messages = [
+        EmailMessage(subject=MAIL_SUBJECTS[row.status], body=MAIL_SUBJECTS[row.status], to=[row.order.customer_mail])
+        for row in rows
+    ]
+    return rows[:send_batch(messages)]
+
+
+def retry_delay(attempts):
+    """Seconds to wait after the `attempts`-th failed delivery of a row."""
+    return min(settings.ORDER_OUTBOX_RETRY_DELAY * 2 ** (attempts - 1), settings.ORDER_OUTBOX_MAX_RETRY_DELAY)
+
+
+def claim_outbox_batch(after_id):
+    """Leases the next ORDER_OUTBOX_BATCH_SIZE outbox rows after `after_id` to this relay run."""
+    claimed_at = timezone.now()
+    expired = claimed_at - timedelta(seconds=settings.ORDER_OUTBOX_LEASE)
+    with transaction.atomic():
+        rows = list(
+            OrderOutbox.objects.select_for_update(skip_locked=True, of=('self',)).select_related('order')
+            .filter(Q(claimed_at=None) | Q(claimed_at__lt=expired), Q(next_try=None) | Q(next_try__lte=claimed_at),
+                    id__gt=after_id, attempts__lt=settings.ORDER_OUTBOX_MAX_ATTEMPTS)
+            .order_by('id')[:settings.ORDER_OUTBOX_BATCH_SIZE]
+        )
+        OrderOutbox.objects.filter(id__in=[row.id for row in rows]).update(claimed_at=claimed_at)
+    return rows, claimed_at
+
+
+@shared_task
+def relay_order_outbox():
+    """Delivers the order status outbox, ORDER_OUTBOX_BATCH_SIZE rows at a time."""
+    stats = {'rows': 0, 'coalesced': 0, 'store_notified': 0, 'mailed': 0, 'failed': 0, 'batches': 0}
+    store_available = True
+    last_id = 0
+    started = time.monotonic()
+
+    while True:
+        rows, claimed_at = claim_outbox_batch(last_id)
+        if not rows:
+            break
+        last_id = rows[-1].id
+        latest = {row.order_id: row for row in rows}
+        superseded = [row.id for row in rows if latest[row.order_id] is not row]
+        rows = list(latest.values())
+
+        to_store = [row for row in rows if row.store_notified is None]
+        if to_store and store_available and notify_store(to_store):
+            for row in to_store:
+                row.store_notified = timezone.now()
+            stats['store_notified'] += len(to_store)
+        elif to_store:
+            store_available = False
+        for row in mail_customers([row for row in rows if row.mailed is None]):
+            row.mailed = timezone.now()
+            stats['mailed'] += 1
+
+        delivered = [row.id for row in rows if row.store_notified and row.mailed]
+        failed = [row for row in rows if not (row.store_notified and row.mailed)]
+        for row in failed:
+            row.attempts += 1
+            row.claimed_at = None
+            row.next_try = timezone.now() + timedelta(seconds=retry_delay(row.attempts))
+            if row.attempts >= settings.ORDER_OUTBOX_MAX_ATTEMPTS:
+                logger.error('Gave up on the status of order %s after %s attempts', row.order_id, row.attempts)
+        with transaction.atomic():
+            # rows whose lease expired meanwhile belong to another run now
+            leased = set(
+                OrderOutbox.objects.select_for_update().filter(id__in=[row.id for row in rows] + superseded,
+                                                               claimed_at=claimed_at).values_list('id', flat=True)
+            )
+            OrderOutbox.objects.filter(id__in=leased.intersection(superseded + delivered)).delete()
+            OrderOutbox.objects.bulk_update(
+                [row for row in failed if row.id in leased],
+                ['store_notified', 'mailed', 'attempts', 'claimed_at', 'next_try'],
+            )
+
+        stats['rows'] += len(rows) + len(superseded)
+        stats['coalesced'] += len(superseded)
+        stats['failed'] += len(failed)
+        stats['batches'] += 1
+
+    stats['seconds'] = round(time.monotonic() - started, 3)
+    return stats
@@ -1,3 +1,366 @@
-# from django.test import TestCase
+import smtplib
+import threading
+import uuid
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.core import mail
+from django.core.mail.backends import locmem
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+import requests
+
+from rest_framework import status
+from rest_framework.test import APIClient, APITestCase
+
+from . import tasks
+from .models import Author, Book, BookInstance, DeletedBook, Genre, Order, OrderItem, OrderOutbox
+
+
+def create_books(count, copies=3):
+    """Books with two authors, two genres and `copies` copies in stock each."""
+    authors = [Author.objects.create(name=f'Author {i}') for i in range(2)]
+    genres = [Genre.objects.create(name=f'Genre {i}') for i in range(2)]
+    books = []
+    for i in range(count):
+        book = Book.objects.create(title=f'Book {i}', summary='Summary', mark=4)
+        book.author.set(authors)
+        book.genre.set(genres)
+        BookInstance.objects.bulk_create([BookInstance(book=book) for _ in range(copies)])
+        books.append(book)
+    return books
+
+
+def order_data(*books):
+    return {
+        'customer_mail': 'reader@example.com', 'customer_name': 'Reader', 'order_date': '2021-09-01',
+        'order_items': [{'book': book.id, 'quantity': 1} for book in books],
+    }
+
+
+@override_settings(CATALOG_EVENTS_BROKER_URL='memory://')
+class QueryBudgetTestCase(APITestCase):
+    """Five books in stock, three of them ordered, to check that a page costs the same queries whatever its size."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.books = create_books(5)
+        for book in cls.books[:3]:
+            Order.objects.create(customer_mail='reader@example.com', customer_name='Reader', order_date='2021-09-01')
+            OrderItem.objects.create(order=Order.objects.latest('order_date'), book=book)
+        DeletedBook.objects.create(book_id=1000)
+        cls.order = Order.objects.first()
+
+    def get_data(self, url, queries):
+        with self.assertNumQueries(queries):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+
+class BookQueryTests(QueryBudgetTestCase):
+    def test_books(self):
+        # page, then the prefetched authors, genres and copies
+        data = self.get_data(reverse('book-list'), 4)
+        self.assertEqual(len(data['results']), 5)
+        self.assertEqual(data['results'][0]['in_stock'], 3)
+        self.get_data(reverse('book-detail', args=[self.books[0].id]), 4)
+
+    def test_books_without_instances(self):
+        self.get_data(reverse('book-list') + '?instances=false', 3)
+
+    def test_book_feeds(self):
+        # as book_sync and the catalog events consumer read them
+        url = reverse('book-list')
+        self.get_data(url + '?updated_since=2021-01-01T00:00:00Z&shard=0&shards=2&page_size=500', 4)
+        ids = ','.join(str(book.id) for book in self.books)
+        self.get_data(url + f'?ids={ids}&instances=false&page_size=500', 3)
+
+    def test_books_large_page(self):
+        create_books(30)
+        data = self.get_data(reverse('book-list') + '?page_size=100', 4)
+        self.assertEqual(len(data['results']), 35)
+
+
+class ListQueryTests(QueryBudgetTestCase):
+    def test_deleted_books(self):
+        self.get_data(reverse('book-deleted'), 1)
+
+    def test_book_instances(self):
+        self.get_data(reverse('bookinstance-list'), 1)
+        self.get_data(reverse('bookinstance-detail', args=[BookInstance.objects.first().id]), 1)
+
+    def test_orders(self):
+        # page, then the prefetched order items
+        self.get_data(reverse('order-list'), 2)
+        self.get_data(reverse('order-detail', args=[self.order.id]), 2)
+
+    def test_order_items(self):
+        self.get_data(reverse('orderitem-list'), 1)
+        self.get_data(reverse('orderitem-detail', args=[OrderItem.objects.first().id]), 1)
+
+    def test_authors_and_genres(self):
+        self.get_data(reverse('author-list'), 1)
+        self.get_data(reverse('author-detail', args=[Author.objects.first().id]), 1)
+        self.get_data(reverse('genre-list'), 1)
+        self.get_data(reverse('genre-detail', args=[Genre.objects.first().id]), 1)
+
+    def test_keyset_pages(self):
+        # the fixture orders share their order_date, only their ids tell them apart
+        Order.objects.create(customer_mail='reader@example.com', customer_name='Reader', order_date='2021-09-02')
+        url, ids = reverse('order-list') + '?page_size=2', []
+        while url:
+            data = self.get_data(url, 2)
+            ids += [order['id'] for order in data['results']]
+            url = data['next']
+        expected = Order.objects.order_by('-order_date', 'id').values_list('id', flat=True)
+        self.assertEqual(ids, [str(order_id) for order_id in expected])
+        self.assertEqual(self.client.get(reverse('order-list') + '?cursor=bad').status_code, 404)
+
+
+class BookStockTests(QueryBudgetTestCase):
+    def test_book_stock(self):
+        data = self.get_data(reverse('book-stock'), 1)
+        self.assertEqual(data['results'][0], {'id': self.books[0].id, 'in_stock': 3, 'reserved': 0, 'sold': 0})
+
+        self.client.post(reverse('order-list'), order_data(self.books[0]), format='json')
+        data = self.get_data(reverse('book-stock') + '?page_size=1', 1)
+        self.assertEqual(data['results'], [{'id': self.books[0].id, 'in_stock': 2, 'reserved': 1, 'sold': 0}])
+
+
+class OrderReservationTests(QueryBudgetTestCase):
+    def test_create_order(self):
+        # the books, the order and its items, then the reservation of each item
+        with self.assertNumQueries(10 + 6 * 2):
+            response = self.client.post(reverse('order-list'), order_data(*self.books[:2]), format='json')
+        self.assertEqual(response.status_code, 201)
+
+    def test_reservations_share_no_copies(self):
+        """Reservations interleaved on one connection, as in one bulk, each get copies of their own."""
+        first, second = self.books[3:]
+        items = []
+        for wanted in [[(second, 1), (first, 1)], [(first, 2)], [(first, 1), (second, 1)]]:
+            order = Order.objects.create(customer_mail='reader@example.com', order_date='2021-09-01')
+            items.append([OrderItem.objects.create(order=order, book=book, quantity=count) for book, count in wanted])
+        with transaction.atomic():
+            shortages = [BookInstance.objects.reserve_for(order_items) for order_items in items]
+
+        self.assertEqual(shortages, [[], [], [{'book': first.id, 'requested': 1, 'available': 0}]])
+        for item, count in zip([*items[0], *items[1], *items[2]], [1, 1, 2, 0, 1]):
+            self.assertEqual(BookInstance.objects.filter(order_item=item).count(), count)
+        stock = {book.id: (book.in_stock, book.reserved) for book in Book.objects.annotate_stock()}
+        self.assertEqual((stock[first.id], stock[second.id]), ((0, 3), (1, 2)))
+
+
+class BulkOrderTests(QueryBudgetTestCase):
+    def test_bulk_orders(self):
+        # a fixed part for the batch, then a savepoint with the reservation per order
+        with self.assertNumQueries(7 + 8 * 4):
+            response = self.client.post(
+                reverse('order-bulk'), [order_data(book) for book in self.books[:4]], format='json'
+            )
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual([result['status'] for result in response.data], [201] * 4)
+
+    def test_orders_fail_on_their_own(self):
+        invalid, short = order_data(self.books[1]), order_data(self.books[2])
+        del invalid['customer_mail']
+        short['order_items'][0]['quantity'] = 4
+        response = self.client.post(reverse('order-bulk'), [order_data(self.books[0]), invalid, short], format='json')
+        self.assertEqual([result['status'] for result in response.data], [201, 400, 409])
+        self.assertEqual(Order.objects.filter(id=response.data[0]['id']).count(), 1)
+        self.assertFalse(Order.objects.filter(id=response.data[2]['id']).exists())
+        stock = {book.id: book.in_stock for book in Book.objects.annotate_stock()}
+        self.assertEqual([stock[book.id] for book in self.books[:3]], [2, 3, 3])
+
+        response = self.client.post(reverse('order-bulk'), order_data(self.books[0]), format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+class IdempotentOrderTests(APITestCase):
+    def setUp(self):
+        self.books = create_books(2)
+
+    def post(self, data, key=None):
+        headers = {'HTTP_IDEMPOTENCY_KEY': key} if key else {}
+        return self.client.post(reverse('order-list'), data, format='json', **headers)
+
+    def test_replay_by_key(self):
+        created = self.post(order_data(self.books[0]), key='key-1')
+        self.assertEqual(created.status_code, 201)
+        self.assertNotIn('Idempotent-Replayed', created)
+
+        with self.assertNumQueries(2):
+            replayed = self.post(order_data(self.books[0]), key='key-1')
+        self.assertEqual((replayed.status_code, replayed['Idempotent-Replayed']), (201, 'true'))
+        self.assertEqual(replayed.data, created.data)
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(BookInstance.objects.filter(status=BookInstance.SellStatus.RESERVED).count(), 1)
+
+    def test_replay_by_id(self):
+        data = dict(order_data(self.books[0]), id=str(uuid.uuid4()))
+        self.assertNotIn('Idempotent-Replayed', self.post(data))
+        replayed = self.post(data)
+        self.assertEqual((replayed.status_code, replayed['Idempotent-Replayed']), (201, 'true'))
+        self.assertEqual(replayed.data['id'], data['id'])
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_reused_key(self):
+        self.post(order_data(self.books[0]), key='key-1')
+        # another body, with or without an order id of its own
+        for data in [order_data(self.books[1]), dict(order_data(self.books[0]), id=str(uuid.uuid4()))]:
+            response = self.post(data, key='key-1')
+            self.assertEqual(response.status_code, 409)
+            self.assertEqual(response.data['detail'].code, 'idempotency_key_reused')
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_replays_in_bulk(self):
+        data = [dict(order_data(book), id=str(uuid.uuid4())) for book in self.books]
+        self.post(data[0])
+        response = self.client.post(reverse('order-bulk'), data, format='json')
+        self.assertEqual([result.get('replayed', False) for result in response.data], [True, False])
+        # a retried batch
+        response = self.client.post(reverse('order-bulk'), data, format='json')
+        self.assertEqual([(result['status'], result['replayed']) for result in response.data], [(201, True)] * 2)
+        self.assertEqual(Order.objects.count(), 2)
+        self.assertEqual(BookInstance.objects.filter(status=BookInstance.SellStatus.RESERVED).count(), 2)
+
+
+class OutOfStockTests(APITestCase):
+    def test_shortages_keep_their_numbers(self):
+        book, = create_books(1, copies=2)
+        shortage = {'book': book.id, 'requested': 3, 'available': 2}
+        data = order_data(book)
+        data['order_items'][0]['quantity'] = 3
+
+        response = self.client.post(reverse('order-list'), data, format='json')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json(), {'detail': 'Not enough copies in stock.', 'order_items': [shortage]})
+        self.assertEqual(Order.objects.count(), 0)
+
+        response = self.client.post(reverse('order-bulk'), [data], format='json')
+        self.assertEqual(response.json()[0]['errors']['order_items'], [shortage])
+        self.assertEqual(Book.objects.annotate_stock().get().in_stock, 2)
+
+
+@override_settings(
+    MAIL_RATE_LIMIT=0, ORDER_OUTBOX_RETRY_DELAY=60, ORDER_OUTBOX_MAX_RETRY_DELAY=180, ORDER_OUTBOX_MAX_ATTEMPTS=3,
+)
+class OrderOutboxTests(TestCase):
+    def setUp(self):
+        self.orders = [
+            Order.objects.create(customer_mail=f'{i}@example.com', customer_name='Reader', order_date='2021-09-01')
+            for i in range(3)
+        ]
+        self.post = mock.patch.object(tasks.requests, 'post').start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_bulk_update_records_changed_orders(self):
+        Order.objects.filter(pk=self.orders[0].pk).update(status=Order.OrderStatus.REJECTED)
+        with self.captureOnCommitCallbacks() as callbacks:
+            Order.objects.update(status=Order.OrderStatus.REJECTED)
+        # the order that already was rejected is not reported again
+        self.assertEqual(
+            sorted(OrderOutbox.objects.values_list('order_id', flat=True)), sorted(o.pk for o in self.orders)
+        )
+        self.assertEqual(OrderOutbox.objects.filter(order=self.orders[0]).count(), 1)
+        self.assertEqual(len(callbacks), 1)
+
+        Order.objects.update(comment='checked')
+        self.assertEqual(OrderOutbox.objects.count(), 3)
+
+    def test_relay_delivers_latest_status_once(self):
+        order = self.orders[0]
+        order.status = Order.OrderStatus.DONE
+        order.save()
+        order.status = Order.OrderStatus.REJECTED
+        order.save()
+
+        stats = tasks.relay_order_outbox()
+        self.assertEqual((stats['coalesced'], stats['store_notified'], stats['mailed']), (1, 1, 1))
+        self.assertEqual(self.post.call_args.kwargs['json'], [{'id': str(order.pk), 'status': 5}])
+        self.assertEqual([message.to for message in mail.outbox], [[order.customer_mail]])
+        self.assertFalse(OrderOutbox.objects.exists())
+
+    def test_refused_mail_is_dropped(self):
+        Order.objects.filter(pk=self.orders[0].pk).update(status=Order.OrderStatus.DONE)
+        refused = smtplib.SMTPRecipientsRefused({self.orders[0].customer_mail: (550, b'No such user')})
+        with mock.patch.object(locmem.EmailBackend, 'send_messages', side_effect=refused):
+            self.assertEqual(tasks.relay_order_outbox()['failed'], 0)
+        self.assertFalse(OrderOutbox.objects.exists())
+
+    def test_failed_callback_is_retried_with_backoff(self):
+        self.post.side_effect = requests.ConnectionError
+        Order.objects.update(status=Order.OrderStatus.DONE)
+
+        self.assertEqual(tasks.relay_order_outbox()['failed'], 3)
+        row = OrderOutbox.objects.first()
+        self.assertEqual(row.attempts, 1)
+        self.assertIsNone(row.store_notified)
+        self.assertIsNotNone(row.mailed)
+        self.assertAlmostEqual(row.next_try, timezone.now() + timedelta(seconds=60), delta=timedelta(seconds=5))
+        # not due yet
+        self.assertEqual(tasks.relay_order_outbox()['rows'], 0)
+
+        self.post.side_effect = None
+        OrderOutbox.objects.update(next_try=timezone.now())
+        self.assertEqual(tasks.relay_order_outbox()['store_notified'], 3)
+        self.assertFalse(OrderOutbox.objects.exists())
+        # the customers were mailed on the first run only
+        self.assertEqual(len(mail.outbox), 3)
+
+    def test_retries_stop_after_max_attempts(self):
+        self.post.side_effect = requests.ConnectionError
+        Order.objects.update(status=Order.OrderStatus.DONE)
+        delays = []
+        for _ in range(3):
+            OrderOutbox.objects.update(next_try=timezone.now())
+            tasks.relay_order_outbox()
+            row = OrderOutbox.objects.first()
+            delays.append(round((row.next_try - timezone.now()).total_seconds() / 60))
+        self.assertEqual(delays, [1, 2, 3])
+
+        OrderOutbox.objects.update(next_try=timezone.now())
+        self.assertEqual(tasks.relay_order_outbox()['rows'], 0)
+        self.assertEqual(set(OrderOutbox.objects.values_list('attempts', flat=True)), {3})
+
+
+@override_settings(CATALOG_EVENTS_BROKER_URL='memory://')
+class ConcurrentOrderTests(TransactionTestCase):
+    def setUp(self):
+        if not connection.features.has_select_for_update_skip_locked:
+            self.skipTest('Needs SELECT ... FOR UPDATE SKIP LOCKED')
+
+    def test_no_oversell(self):
+        """Concurrent orders of the same books, in opposite item orders, never get more copies than there are."""
+        first, second = create_books(2, copies=5)
+        payloads = [order_data(first, second) if i % 2 else order_data(second, first) for i in range(8)]
+        barrier = threading.Barrier(len(payloads))
+        statuses = []
+
+        def place(data):
+            try:
+                client = APIClient()
+                barrier.wait()
+                statuses.append(client.post(reverse('order-list'), data, format='json').status_code)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=place, args=[data]) for data in payloads]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # copies locked by an order that is rolled back later are skipped, so fewer than 5 orders may get through
+        self.assertEqual(set(statuses) - {201, 409}, set())
+        created = statuses.count(201)
+        self.assertTrue(1 <= created <= 5)
+        self.assertEqual(Order.objects.count(), created)
+        for book in Book.objects.filter(id__in=[first.id, second.id]).annotate_stock():
+            self.assertEqual((book.in_stock, book.reserved), (5 - created, created))
+            reserved = BookInstance.objects.filter(book=book, status=BookInstance.SellStatus.RESERVED)
+            self.assertEqual(reserved.values('order_item__order').distinct().count(), created)
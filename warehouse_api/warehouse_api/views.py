@@ -1,36 +1,266 @@
-from rest_framework import viewsets
+import hashlib
+import json
+import uuid
+from collections import defaultdict
 
-from .models import Author, Book, BookInstance, Genre, Order, OrderItem
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.db.models.functions import Mod
+from django.utils.dateparse import parse_datetime
+
+from rest_framework import status, viewsets
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+
+from .exceptions import IdempotencyKeyReused, OutOfStock
+from .models import Author, Book, BookInstance, DeletedBook, Genre, Order, OrderItem, lock_stock
 from .serializers import AuthorSerializer, BookInstanceSerializer, BookSerializer, GenreSerializer, OrderItemSerializer
-from .serializers import OrderSerializer
+from .serializers import BookStockSerializer, BulkOrderSerializer, DeletedBookSerializer, OrderSerializer
+from .serializers import include_instances
+
+
+def request_fingerprint(data):
+    """Digest of a request body, which tells a replay under an Idempotency-Key from a reuse of the key."""
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def get_updated_since(request):
+    """Parses the `updated_since` change cursor from the query string (None if it was not given)."""
+    value = request.query_params.get('updated_since')
+    if not value:
+        return None
+    updated_since = parse_datetime(value)
+    if updated_since is None:
+        raise ValidationError({'updated_since': 'Expected an ISO 8601 datetime.'})
+    return updated_since
+
+
+def get_shard(request):
+    """Parses the `shard`/`shards` pair used to split a feed into independent streams (None if not given)."""
+    if 'shards' not in request.query_params:
+        return None
+    try:
+        shard, shards = int(request.query_params.get('shard', 0)), int(request.query_params['shards'])
+    except ValueError:
+        raise ValidationError({'shards': 'Expected integers.'})
+    if not 0 <= shard < shards:
+        raise ValidationError({'shard': 'Expected 0 <= shard < shards.'})
+    return shard, shards
+
+
+def get_ids(request):
+    """Parses the comma separated `ids` filter from the query string (None if it was not given)."""
+    value = request.query_params.get('ids')
+    if not value:
+        return None
+    try:
+        return [int(book_id) for book_id in value.split(',')]
+    except ValueError:
+        raise ValidationError({'ids': 'Expected a comma separated list of integers.'})
+
+
+def _ids_in(values):
+    ids = set()
+    for value in values:
+        try:
+            ids.add(int(value))
+        except (TypeError, ValueError):
+            pass
+    return ids
+
+
+def _uuids_in(values):
+    uuids = set()
+    for value in values:
+        try:
+            uuids.add(uuid.UUID(str(value)))
+        except ValueError:
+            pass
+    return uuids
 
 
 class AuthorViewSet(viewsets.ModelViewSet):
-    queryset = Author.objects.all()
+    queryset = Author.objects.all().order_by('name', 'id')
     serializer_class = AuthorSerializer
+    keyset_ordering = ('name', 'id')
     # permission_classes = [permissions.IsAuthenticatedOrReadOnly]
 
 
 class GenreViewSet(viewsets.ModelViewSet):
-    queryset = Genre.objects.all()
+    queryset = Genre.objects.all().order_by('name', 'id')
     serializer_class = GenreSerializer
+    keyset_ordering = ('name', 'id')
 
 
 class BookViewSet(viewsets.ModelViewSet):
-    queryset = Book.objects.all().order_by('title')
+    queryset = Book.objects.all().order_by('title', 'id')
     serializer_class = BookSerializer
 
+    def get_keyset_ordering(self):
+        if self.action == 'deleted':
+            return 'deleted', 'id'
+        if self.action == 'stock':
+            return 'id',
+        if get_updated_since(self.request) is not None:
+            return 'updated', 'id'
+        return 'title', 'id'
+
+    def get_queryset(self):
+        # one query per nested relation instead of three per book on every page
+        queryset = super().get_queryset().prefetch_related('author', 'genre').annotate_stock()
+        if include_instances(self.request):
+            queryset = queryset.prefetch_related('bookinstance_set')
+        updated_since = get_updated_since(self.request)
+        if updated_since is not None:
+            # oldest changes first, so the consumer can advance its cursor page by page
+            queryset = queryset.filter(updated__gte=updated_since).order_by('updated', 'id')
+        shard = get_shard(self.request)
+        if shard is not None:
+            queryset = queryset.annotate(shard=Mod('id', shard[1])).filter(shard=shard[0])
+        ids = get_ids(self.request)
+        if ids is not None:
+            # current state of the books named by catalog events
+            queryset = queryset.filter(id__in=ids)
+        return queryset
+
+    @action(detail=False, serializer_class=DeletedBookSerializer)
+    def deleted(self, request):
+        """Books deleted since `updated_since` (all tombstones if the cursor is not given)."""
+        queryset = DeletedBook.objects.all()
+        updated_since = get_updated_since(request)
+        if updated_since is not None:
+            queryset = queryset.filter(deleted__gte=updated_since)
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(self.get_serializer(page, many=True).data)
+        return Response(self.get_serializer(queryset, many=True).data)
+
+    @action(detail=False, serializer_class=BookStockSerializer)
+    def stock(self, request):
+        """Copies of each book by sell status, read from the maintained counters; `?ids=1,2` filters books."""
+        queryset = Book.objects.only('id').annotate_stock()
+        ids = get_ids(request)
+        if ids is not None:
+            queryset = queryset.filter(id__in=ids)
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(self.get_serializer(page, many=True).data)
+        return Response(self.get_serializer(queryset, many=True).data)
+
 
 class BookInstanceViewSet(viewsets.ModelViewSet):
-    queryset = BookInstance.objects.all().order_by('book__title')
+    queryset = BookInstance.objects.all().order_by('id')
     serializer_class = BookInstanceSerializer
+    keyset_ordering = ('id',)
 
 
 class OrderViewSet(viewsets.ModelViewSet):
-    queryset = Order.objects.all().order_by('-order_date')
+    queryset = Order.objects.prefetch_related('orderitem_set').order_by('-order_date', 'id')
     serializer_class = OrderSerializer
+    keyset_ordering = ('-order_date', 'id')
+    bulk_max_orders = 500
+
+    def create(self, request, *args, **kwargs):
+        """Idempotent on the order id and on the optional Idempotency-Key header."""
+        key = request.headers.get('Idempotency-Key')
+        order = self.find_replayed(request.data, key)
+        if order is None:
+            try:
+                return super().create(request, *args, **kwargs)
+            except IntegrityError:
+                # a concurrent request with the same id or key won the race
+                order = self.find_replayed(request.data, key)
+                if order is None:
+                    raise
+        serializer = self.get_serializer(order)
+        headers = self.get_success_headers(serializer.data)
+        headers['Idempotent-Replayed'] = 'true'
+        return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
+
+    def perform_create(self, serializer):
+        key = self.request.headers.get('Idempotency-Key')
+        fingerprint = request_fingerprint(self.request.data) if key else ''
+        serializer.save(idempotency_key=key, idempotency_fingerprint=fingerprint)
+
+    def find_replayed(self, data, key):
+        """The already stored order with the id in `data` or with the idempotency `key`, if any."""
+        order_ids = _uuids_in([data.get('id')]) if isinstance(data, dict) else set()
+        lookup = Q(id__in=order_ids)
+        if key:
+            lookup |= Q(idempotency_key=key)
+        order = self.get_queryset().filter(lookup).first()
+        if order is not None and order_ids and order.id not in order_ids:
+            raise IdempotencyKeyReused()
+        if order is not None and key and order.idempotency_key == key and order.idempotency_fingerprint not in (
+            '', request_fingerprint(data)
+        ):
+            raise IdempotencyKeyReused()
+        return order
+
+    @action(detail=False, methods=['post'], serializer_class=BulkOrderSerializer)
+    def bulk(self, request):
+        """Ingests a list of orders at once and answers with a result per order (207 Multi-Status)."""
+        if not isinstance(request.data, list) or not all(isinstance(data, dict) for data in request.data):
+            raise ValidationError({'non_field_errors': ['Expected a list of orders.']})
+        if len(request.data) > self.bulk_max_orders:
+            raise ValidationError({'non_field_errors': [f'At most {self.bulk_max_orders} orders per request.']})
+
+        context = self.get_serializer_context()
+        context['books'] = Book.objects.in_bulk(_ids_in(
+            item.get('book') for data in request.data for item in data.get('order_items') or []
+            if isinstance(item, dict)
+        ))
+        known = {str(order_id) for order_id in Order.objects.filter(
+            id__in=_uuids_in(data.get('id') for data in request.data)
+        ).values_list('id', flat=True)}
+
+        results, accepted = [], []
+        for data in request.data:
+            serializer = self.get_serializer(data=data, context=context)
+            if not serializer.is_valid():
+                results.append(
+                    {'id': data.get('id'), 'status': status.HTTP_400_BAD_REQUEST, 'errors': serializer.errors}
+                )
+                continue
+            validated_data = dict(serializer.validated_data)
+            order_items = validated_data.pop('orderitem_set')
+            order = Order(**validated_data)
+            if str(order.id) in known:
+                # already ingested (a retried batch): report it as created without touching it again
+                results.append({'id': str(order.id), 'status': status.HTTP_201_CREATED, 'replayed': True})
+                continue
+            known.add(str(order.id))
+            results.append({'id': str(order.id), 'status': status.HTTP_201_CREATED})
+            accepted.append((results[-1], order, order_items))
+
+        with transaction.atomic():
+            # in id order up front, orders reserve in payload order and overlapping batches would deadlock
+            lock_stock({item['book'].id for _, _, order_items in accepted for item in order_items})
+            Order.objects.bulk_create([order for _, order, _ in accepted])
+            OrderItem.objects.bulk_create([
+                OrderItem(order=order, **item) for _, order, order_items in accepted for item in order_items
+            ])
+            items = defaultdict(list)
+            for order_item in OrderItem.objects.filter(order__in=[order for _, order, _ in accepted]):
+                items[order_item.order_id].append(order_item)
+
+            rejected = []
+            for result, order, _ in accepted:
+                with transaction.atomic():
+                    shortages = BookInstance.objects.reserve_for(items[order.id])
+                    if shortages:
+                        transaction.set_rollback(True)
+                if shortages:
+                    rejected.append(order.id)
+                    result.update(status=OutOfStock.status_code, errors=OutOfStock(shortages).detail)
+            if rejected:
+                Order.objects.filter(id__in=rejected).delete()
+
+        return Response(results, status=status.HTTP_207_MULTI_STATUS)
 
 
 class OrderItemViewSet(viewsets.ModelViewSet):
-    queryset = OrderItem.objects.all().order_by('order')
+    queryset = OrderItem.objects.all().order_by('id')
     serializer_class = OrderItemSerializer
+    keyset_ordering = ('id',)